@@ -0,0 +1,326 @@
+import argparse
+import json
+import os.path
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import psycopg2
+import psycopg2.extras
+import fake_flickr_api
+
+
+benchmarks_dir              = os.path.dirname( os.path.abspath(__file__) )
+create_fga_db_sql_filename  = os.path.join( benchmarks_dir, "..", "db", "create_fga_db.sql" )
+add_images_script_filename  = os.path.join( benchmarks_dir, "..", "venv", "Scripts", "add_images_to_groups.py" )
+
+
+def _parse_args():
+    arg_parser = argparse.ArgumentParser(
+        description="Run add_images_to_groups.py end to end against a local Flickr stand-in and measure it. " +
+            "The Postgres database is wiped and reseeded, so point this at a scratch database." )
+    arg_parser.add_argument( "postgres_creds_json", help="JSON file with DB credentials (scratch DB)" )
+    arg_parser.add_argument( "--users", type=int, default=50 )
+    arg_parser.add_argument( "--groups", type=int, default=40, help="Groups in the synthetic world" )
+    arg_parser.add_argument( "--groups-per-user", type=int, default=15, help="Groups each user is a member of" )
+    arg_parser.add_argument( "--photos-per-user", type=int, default=20 )
+    arg_parser.add_argument( "--requests-per-photo", type=int, default=5,
+        help="Groups each photo is requested into (some will be groups the user isn't in)" )
+    arg_parser.add_argument( "--already-in-pool-fraction", type=float, default=0.1,
+        help="Fraction of requested photo/group pairs where the photo is already in the pool" )
+    arg_parser.add_argument( "--moderated-group-fraction", type=float, default=0.1 )
+    arg_parser.add_argument( "--group-throttle", type=int, default=10,
+        help="Adds per user per group per day before Flickr answers Error: 5" )
+    arg_parser.add_argument( "--latency-ms", type=float, default=50 )
+    arg_parser.add_argument( "--latency-jitter-ms", type=float, default=20 )
+    arg_parser.add_argument( "--error-rate", type=float, default=0.0 )
+    arg_parser.add_argument( "--random-seed", type=int, default=1 )
+    arg_parser.add_argument( "--add-images-args", default="--dispatch-mode per_user",
+        help="Extra arguments for add_images_to_groups.py. Serial mode only authenticates as one of the " +
+            "synthetic users, so most of its requests fail" )
+    arg_parser.add_argument( "--results-json", default=None, help="Save this run's results here" )
+    arg_parser.add_argument( "--baseline-json", default=None, help="Compare against results saved by an earlier run" )
+    return arg_parser.parse_args()
+
+
+def _connect_to_db( pgsql_creds ):
+    return psycopg2.connect(
+        host        = pgsql_creds['db_host'],
+        user        = pgsql_creds['db_user'],
+        password    = pgsql_creds['db_passwd'],
+        database    = pgsql_creds['db_dbname'] )
+
+
+def _build_synthetic_world( args ):
+    random_generator = random.Random( args.random_seed )
+
+    world = {
+        'users'     : {},
+        'groups'    : {},
+        'photos'    : {},
+    }
+    submitted_requests = []
+
+    group_ids = [ f"{9000000 + group_index}@N2{group_index % 10}" for group_index in range( args.groups ) ]
+    for group_id in group_ids:
+        world['groups'][ group_id ] = {
+            'name'      : f"Benchmark group {group_id}",
+            'moderated' : random_generator.random() < args.moderated_group_fraction,
+            'throttle'  : args.group_throttle,
+        }
+
+    for user_index in range( args.users ):
+        user_cognito_id = str( uuid.UUID(int=random_generator.getrandbits(128)) )
+        oauth_token = f"token-{user_index}"
+        user_group_ids = random_generator.sample( group_ids, min(args.groups_per_user, len(group_ids)) )
+
+        world['users'][ oauth_token ] = {
+            'nsid'          : f"{1000000 + user_index}@N00",
+            'groups'        : user_group_ids,
+            'cognito_id'    : user_cognito_id,
+        }
+
+        for photo_index in range( args.photos_per_user ):
+            photo_id = str( 50000000000 + user_index * args.photos_per_user + photo_index )
+            requested_group_ids = random_generator.sample( group_ids, min(args.requests_per_photo, len(group_ids)) )
+
+            world['photos'][ photo_id ] = {
+                'owner_token'   : oauth_token,
+                'pools'         : [ group_id for group_id in requested_group_ids
+                    if group_id in user_group_ids and random_generator.random() < args.already_in_pool_fraction ],
+            }
+
+            for group_id in requested_group_ids:
+                submitted_requests.append( (str(uuid.UUID(int=random_generator.getrandbits(128))), user_cognito_id,
+                    photo_id, group_id) )
+
+    return ( world, submitted_requests )
+
+
+def _write_run_files( run_dir, world ):
+    run_files = {
+        'app_api_key_info_json' : os.path.join( run_dir, "app_api_key_info.json" ),
+        'user_auth_info_dir'    : os.path.join( run_dir, "user_auth" ),
+        'lookup_cache_db'       : os.path.join( run_dir, "lookup_cache.sqlite3" ),
+        'output_log'            : os.path.join( run_dir, "add_images_to_groups.log" ),
+        'metrics_jsonl'         : os.path.join( run_dir, "metrics.jsonl" ),
+    }
+
+    with open( run_files['app_api_key_info_json'], "w" ) as app_api_key_info_handle:
+        json.dump( { 'api_key': "benchmark-key", 'api_key_secret': "benchmark-secret" }, app_api_key_info_handle )
+
+    os.mkdir( run_files['user_auth_info_dir'] )
+    for oauth_token in world['users']:
+        user_info = world['users'][ oauth_token ]
+        user_auth_info = {
+            'user_oauth_token'          : oauth_token,
+            'user_oauth_token_secret'   : f"{oauth_token}-secret",
+            'user_fullname'             : f"Benchmark User {user_info['nsid']}",
+            'username'                  : f"benchmark_{user_info['nsid']}",
+            'user_nsid'                 : user_info['nsid'],
+        }
+
+        with open( os.path.join(run_files['user_auth_info_dir'], f"{user_info['cognito_id']}.json"), "w" ) \
+                as user_auth_info_handle:
+            json.dump( user_auth_info, user_auth_info_handle )
+
+        # The positional user auth file; only used in serial mode
+        run_files.setdefault( 'default_user_auth_info_json',
+            os.path.join(run_files['user_auth_info_dir'], f"{user_info['cognito_id']}.json") )
+
+    return run_files
+
+
+def _seed_database( pgsql_creds, submitted_requests ):
+    with open( create_fga_db_sql_filename, "r" ) as create_sql_handle:
+        create_sql = create_sql_handle.read()
+
+    db_seed_start = time.perf_counter()
+
+    with _connect_to_db( pgsql_creds ) as db_conn:
+        with db_conn.cursor() as db_cursor:
+            db_cursor.execute( create_sql )
+            psycopg2.extras.execute_values( db_cursor, """
+                INSERT INTO submitted_requests( uuid_pk, flickr_user_cognito_id, picture_flickr_id, flickr_group_id,
+                    request_datetime )
+                VALUES %s;
+            """, submitted_requests, template="( %s, %s, %s, %s, NOW() )", page_size=1000 )
+
+    db_conn.close()
+
+    return time.perf_counter() - db_seed_start
+
+
+def _reset_db_statement_stats( db_conn ):
+    # pg_stat_statements is optional; without it DB time isn't reported
+    try:
+        with db_conn.cursor() as db_cursor:
+            db_cursor.execute( "SELECT pg_stat_statements_reset();" )
+        db_conn.commit()
+        return True
+    except psycopg2.Error:
+        db_conn.rollback()
+        return False
+
+
+def _read_db_statement_seconds( db_conn ):
+    for total_time_column in ( "total_exec_time", "total_time" ):
+        try:
+            with db_conn.cursor() as db_cursor:
+                db_cursor.execute( f"""
+                    SELECT COALESCE( SUM({total_time_column}), 0 ) / 1000.0
+                    FROM pg_stat_statements
+                    WHERE dbid = ( SELECT oid FROM pg_database WHERE datname = current_database() )
+                        AND query NOT ILIKE '%pg_stat_statements%';
+                """ )
+                db_statement_seconds = float( db_cursor.fetchone()[0] )
+            db_conn.rollback()
+            return db_statement_seconds
+        except psycopg2.Error:
+            db_conn.rollback()
+
+    return None
+
+
+def _read_final_status_counts( db_conn ):
+    with db_conn.cursor() as db_cursor:
+        db_cursor.execute( """
+            SELECT COALESCE( final_status, 'incomplete' ), COUNT(*)
+            FROM group_add_attempts
+            GROUP BY 1;
+        """ )
+        final_status_counts = { curr_row[0]: curr_row[1] for curr_row in db_cursor.fetchall() }
+    db_conn.rollback()
+
+    return final_status_counts
+
+
+def _run_add_images_to_groups( args, run_files, rest_url ):
+    add_images_command = [
+        sys.executable, add_images_script_filename,
+        run_files['app_api_key_info_json'],
+        run_files['default_user_auth_info_json'],
+        args.postgres_creds_json,
+        "--flickr-api-rest-url", rest_url,
+        "--user-auth-info-dir", run_files['user_auth_info_dir'],
+        "--lookup-cache-db", run_files['lookup_cache_db'],
+        "--metrics-jsonl", run_files['metrics_jsonl'],
+        # The stand-in has no call budget; let the run go flat out unless told otherwise
+        "--api-calls-per-hour", "1000000000",
+    ] + args.add_images_args.split()
+
+    with open( run_files['output_log'], "w" ) as output_log_handle:
+        run_start = time.perf_counter()
+        subprocess.run( add_images_command, stdout=output_log_handle, stderr=subprocess.STDOUT, check=True,
+            cwd=os.path.dirname(add_images_script_filename) )
+        run_seconds = time.perf_counter() - run_start
+
+    # ru_maxrss is in kilobytes on Linux; there's only ever one child so this is its peak
+    peak_rss_mb = resource.getrusage( resource.RUSAGE_CHILDREN ).ru_maxrss / 1024.0
+
+    return ( run_seconds, peak_rss_mb )
+
+
+def _read_client_sql_seconds( metrics_jsonl_filename ):
+    # Time add_images_to_groups.py itself spent waiting on SQL statements, round trips included
+    client_sql_seconds = 0.0
+    with open( metrics_jsonl_filename, "r" ) as metrics_jsonl_handle:
+        for metrics_line in metrics_jsonl_handle:
+            metric_record = json.loads( metrics_line )
+            if metric_record['metric'] == "fga_sql_statement_seconds":
+                client_sql_seconds += metric_record['sum']
+
+    return client_sql_seconds
+
+
+def _print_comparison( results, baseline_results ):
+    print( "\nCompared to baseline:" )
+    for metric_name in ( "requests_per_second", "api_calls_per_request", "db_seconds", "client_sql_seconds",
+            "peak_rss_mb", "run_seconds" ):
+        current_value = results.get( metric_name )
+        baseline_value = baseline_results.get( metric_name )
+        if current_value is None or baseline_value is None or baseline_value == 0:
+            print( f"\t{metric_name:<24} {current_value} (baseline {baseline_value})" )
+            continue
+
+        change_percent = ( current_value - baseline_value ) / baseline_value * 100.0
+        print( f"\t{metric_name:<24} {current_value:12.3f} vs {baseline_value:12.3f} ({change_percent:+.1f}%)" )
+
+
+def _main():
+    args = _parse_args()
+
+    with open( args.postgres_creds_json, "r" ) as pgsql_creds_handle:
+        pgsql_creds = json.load( pgsql_creds_handle )
+
+    ( world, submitted_requests ) = _build_synthetic_world( args )
+    print( f"Synthetic world: {len(world['users'])} users, {len(world['groups'])} groups, " +
+        f"{len(world['photos'])} photos, {len(submitted_requests)} requests" )
+
+    with tempfile.TemporaryDirectory( prefix="fga_benchmark_" ) as run_dir:
+        run_files = _write_run_files( run_dir, world )
+
+        db_seed_seconds = _seed_database( pgsql_creds, submitted_requests )
+        print( f"Seeded Postgres in {db_seed_seconds:.2f}s" )
+
+        fake_flickr = fake_flickr_api.FakeFlickrApi( world, args.latency_ms, args.latency_jitter_ms, args.error_rate,
+            args.group_throttle, args.random_seed )
+        ( http_server, rest_url ) = fake_flickr_api.start_fake_flickr_api_server( fake_flickr )
+        print( f"Fake Flickr API at {rest_url}" )
+
+        db_conn = _connect_to_db( pgsql_creds )
+        try:
+            have_db_statement_stats = _reset_db_statement_stats( db_conn )
+
+            print( f"Running add_images_to_groups.py {args.add_images_args}" )
+            ( run_seconds, peak_rss_mb ) = _run_add_images_to_groups( args, run_files, rest_url )
+
+            db_seconds = _read_db_statement_seconds( db_conn ) if have_db_statement_stats else None
+            final_status_counts = _read_final_status_counts( db_conn )
+        finally:
+            db_conn.close()
+            http_server.shutdown()
+
+        api_stats = fake_flickr.get_stats()
+        requests_processed = sum( final_status_counts.values() )
+
+        results = {
+            'add_images_args'       : args.add_images_args,
+            'world'                 : {
+                'users'             : args.users,
+                'groups'            : args.groups,
+                'photos'            : len( world['photos'] ),
+                'requests'          : len( submitted_requests ),
+                'latency_ms'        : args.latency_ms,
+                'latency_jitter_ms' : args.latency_jitter_ms,
+                'error_rate'        : args.error_rate,
+                'group_throttle'    : args.group_throttle,
+            },
+            'requests_processed'    : requests_processed,
+            'run_seconds'           : run_seconds,
+            'requests_per_second'   : requests_processed / run_seconds if run_seconds > 0 else None,
+            'api_calls'             : api_stats['total_calls'],
+            'api_calls_per_method'  : api_stats['calls_per_method'],
+            'api_calls_per_request' : api_stats['total_calls'] / requests_processed if requests_processed else None,
+            'db_seconds'            : db_seconds,
+            'client_sql_seconds'    : _read_client_sql_seconds( run_files['metrics_jsonl'] ),
+            'peak_rss_mb'           : peak_rss_mb,
+            'final_status_counts'   : final_status_counts,
+        }
+
+    print( "\nResults:\n" + json.dumps(results, indent=4, sort_keys=True) )
+
+    if args.baseline_json is not None:
+        with open( args.baseline_json, "r" ) as baseline_handle:
+            _print_comparison( results, json.load(baseline_handle) )
+
+    if args.results_json is not None:
+        with open( args.results_json, "w" ) as results_handle:
+            json.dump( results, results_handle, indent=4, sort_keys=True )
+
+
+if __name__ == "__main__":
+    _main()
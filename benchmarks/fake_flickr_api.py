@@ -0,0 +1,269 @@
+import argparse
+import datetime
+import http.server
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+
+# Flickr error codes for groups.pools.add
+error_photo_not_found               = ( 1, "Photo not found" )
+error_group_not_found               = ( 2, "Group not found" )
+error_photo_already_in_pool         = ( 3, "Photo already in pool" )
+error_group_throttle_reached        = ( 5, "Photo limit reached" )
+error_added_to_pending_queue        = ( 6, "Your Photo has been added to the Pending Queue for this Pool" )
+error_already_in_pending_queue      = ( 7, "Your Photo has already been added to the Pending Queue for this Pool" )
+error_invalid_auth_token            = ( 98, "Invalid auth token" )
+error_service_unavailable           = ( 105, "Service currently unavailable" )
+error_method_not_found              = ( 112, "Method not found" )
+
+
+class FakeFlickrApi:
+    """
+    Stand-in for the parts of the Flickr REST API the FGA tools use: groups.pools.add,
+    groups.pools.getGroups and photos.getAllContexts.
+
+    The world it serves looks like:
+
+        {
+            "users"     : { "<oauth token>": { "nsid": "...", "groups": [ "<group id>", ... ] } },
+            "groups"    : { "<group id>": { "name": "...", "moderated": false, "throttle": 10 } },
+            "photos"    : { "<photo id>": { "owner_token": "<oauth token>", "pools": [ "<group id>", ... ] } }
+        }
+
+    A group's "throttle" is how many photos one user may add to it per UTC day before getting
+    "Error: 5"; moderated groups answer "Error: 6" (added to pending queue). Every call sleeps for
+    latency_ms plus up to latency_jitter_ms, and fails with "Error: 105" with probability error_rate.
+    Calls are counted per method.
+    """
+
+    def __init__( self, world, latency_ms=0, latency_jitter_ms=0, error_rate=0.0, default_group_throttle=None,
+            random_seed=None ):
+
+        self._world                     = world
+        self._latency_seconds           = latency_ms / 1000.0
+        self._latency_jitter_seconds    = latency_jitter_ms / 1000.0
+        self._error_rate                = error_rate
+        self._default_group_throttle    = default_group_throttle
+        self._random                    = random.Random( random_seed )
+        self._lock                      = threading.Lock()
+        self._adds_per_user_group_day   = {}
+        self._pending_queue             = set()
+        self._calls_per_method          = {}
+
+        self._method_handlers = {
+            "flickr.groups.pools.add"       : self._groups_pools_add,
+            "flickr.groups.pools.getGroups" : self._groups_pools_get_groups,
+            "flickr.photos.getAllContexts"  : self._photos_get_all_contexts,
+        }
+
+    def handle_call( self, oauth_token, api_params ):
+        method_name = api_params.get( "method", "" )
+
+        with self._lock:
+            self._calls_per_method[ method_name ] = self._calls_per_method.get( method_name, 0 ) + 1
+            simulated_latency = self._latency_seconds + self._random.random() * self._latency_jitter_seconds
+            simulate_error = self._random.random() < self._error_rate
+
+        if simulated_latency > 0:
+            time.sleep( simulated_latency )
+
+        if simulate_error:
+            return _error_response( error_service_unavailable )
+
+        if method_name not in self._method_handlers:
+            return _error_response( error_method_not_found )
+
+        if oauth_token not in self._world['users']:
+            return _error_response( error_invalid_auth_token )
+
+        with self._lock:
+            return self._method_handlers[ method_name ]( oauth_token, api_params )
+
+    def get_stats( self ):
+        with self._lock:
+            return {
+                'calls_per_method'  : dict( self._calls_per_method ),
+                'total_calls'       : sum( self._calls_per_method.values() ),
+            }
+
+    def reset_stats( self ):
+        with self._lock:
+            self._calls_per_method = {}
+
+    def _groups_pools_add( self, oauth_token, api_params ):
+        photo_id = api_params.get( "photo_id" )
+        group_id = api_params.get( "group_id" )
+
+        if photo_id not in self._world['photos'] or self._world['photos'][photo_id]['owner_token'] != oauth_token:
+            return _error_response( error_photo_not_found )
+
+        if group_id not in self._world['groups'] or group_id not in self._world['users'][oauth_token]['groups']:
+            return _error_response( error_group_not_found )
+
+        photo_info = self._world['photos'][ photo_id ]
+        group_info = self._world['groups'][ group_id ]
+
+        if group_id in photo_info['pools']:
+            return _error_response( error_photo_already_in_pool )
+
+        if (photo_id, group_id) in self._pending_queue:
+            return _error_response( error_already_in_pending_queue )
+
+        group_throttle = group_info.get( "throttle", self._default_group_throttle )
+        throttle_key = ( oauth_token, group_id, datetime.datetime.now(datetime.timezone.utc).date() )
+        if group_throttle is not None and self._adds_per_user_group_day.get( throttle_key, 0 ) >= group_throttle:
+            return _error_response( error_group_throttle_reached )
+
+        self._adds_per_user_group_day[ throttle_key ] = self._adds_per_user_group_day.get( throttle_key, 0 ) + 1
+
+        if group_info.get( "moderated", False ):
+            self._pending_queue.add( (photo_id, group_id) )
+            return _error_response( error_added_to_pending_queue )
+
+        photo_info['pools'].append( group_id )
+        return { "stat": "ok" }
+
+    def _groups_pools_get_groups( self, oauth_token, api_params ):
+        user_groups = []
+        for group_id in self._world['users'][oauth_token]['groups']:
+            user_groups.append( {
+                "id"    : group_id,
+                "nsid"  : group_id,
+                "name"  : self._world['groups'][group_id]['name'],
+            } )
+
+        return {
+            "groups": {
+                "group": user_groups,
+            },
+            "stat"  : "ok",
+        }
+
+    def _photos_get_all_contexts( self, oauth_token, api_params ):
+        photo_id = api_params.get( "photo_id" )
+        if photo_id not in self._world['photos']:
+            return _error_response( error_photo_not_found )
+
+        contexts = { "stat": "ok" }
+        photo_pools = self._world['photos'][ photo_id ]['pools']
+        if photo_pools:
+            contexts['pool'] = [ { "id": group_id, "title": self._world['groups'][group_id]['name'] }
+                for group_id in photo_pools ]
+
+        return contexts
+
+
+def _error_response( flickr_error ):
+    return {
+        "stat"      : "fail",
+        "code"      : flickr_error[0],
+        "message"   : flickr_error[1],
+    }
+
+
+class _FakeFlickrRequestHandler( http.server.BaseHTTPRequestHandler ):
+    fake_flickr_api = None
+
+    def do_GET( self ):
+        parsed_url = urllib.parse.urlparse( self.path )
+
+        if parsed_url.path == "/stats":
+            self._send_json( self.fake_flickr_api.get_stats() )
+            return
+
+        self._handle_api_call( urllib.parse.parse_qs(parsed_url.query) )
+
+    def do_POST( self ):
+        parsed_url = urllib.parse.urlparse( self.path )
+
+        if parsed_url.path == "/reset_stats":
+            self.fake_flickr_api.reset_stats()
+            self._send_json( { "stat": "ok" } )
+            return
+
+        content_length = int( self.headers.get("Content-Length", 0) )
+        request_body = self.rfile.read( content_length ).decode( "utf-8" )
+
+        api_params = urllib.parse.parse_qs( parsed_url.query )
+        api_params.update( urllib.parse.parse_qs(request_body) )
+        self._handle_api_call( api_params )
+
+    def log_message( self, format, *args ):
+        # One line per call would swamp the benchmark output
+        pass
+
+    def _handle_api_call( self, api_params ):
+        api_params = { param_name: param_values[0] for ( param_name, param_values ) in api_params.items() }
+
+        # flickrapi signs with OAuth in the Authorization header; fall back to a query/body parameter
+        oauth_token = api_params.get( "oauth_token" )
+        authorization_header = self.headers.get( "Authorization", "" )
+        header_token_match = re.search( r'oauth_token="([^"]*)"', authorization_header )
+        if header_token_match is not None:
+            oauth_token = urllib.parse.unquote( header_token_match.group(1) )
+
+        self._send_json( self.fake_flickr_api.handle_call(oauth_token, api_params) )
+
+    def _send_json( self, response_body ):
+        encoded_body = json.dumps( response_body ).encode( "utf-8" )
+        self.send_response( 200 )
+        self.send_header( "Content-Type", "application/json" )
+        self.send_header( "Content-Length", str(len(encoded_body)) )
+        self.end_headers()
+        self.wfile.write( encoded_body )
+
+
+def start_fake_flickr_api_server( fake_flickr_api, listen_host="127.0.0.1", listen_port=0 ):
+    # Port 0 picks a free port; the REST URL to hand to add_images_to_groups.py is returned with the server
+    request_handler_class = type( "FakeFlickrRequestHandler", (_FakeFlickrRequestHandler,),
+        { "fake_flickr_api": fake_flickr_api } )
+
+    http_server = http.server.ThreadingHTTPServer( (listen_host, listen_port), request_handler_class )
+    http_server.daemon_threads = True
+
+    server_thread = threading.Thread( target=http_server.serve_forever, daemon=True )
+    server_thread.start()
+
+    rest_url = f"http://{http_server.server_address[0]}:{http_server.server_address[1]}/services/rest/"
+
+    return ( http_server, rest_url )
+
+
+def _parse_args():
+    arg_parser = argparse.ArgumentParser( description="Local stand-in for the Flickr REST API" )
+    arg_parser.add_argument( "world_json", help="JSON file with the users, groups and photos to serve" )
+    arg_parser.add_argument( "--listen-host", default="127.0.0.1" )
+    arg_parser.add_argument( "--listen-port", type=int, default=8089 )
+    arg_parser.add_argument( "--latency-ms", type=float, default=0, help="Added to every call" )
+    arg_parser.add_argument( "--latency-jitter-ms", type=float, default=0, help="Random extra latency, up to this" )
+    arg_parser.add_argument( "--error-rate", type=float, default=0.0,
+        help="Probability any call fails with Error: 105 (service unavailable)" )
+    arg_parser.add_argument( "--default-group-throttle", type=int, default=None,
+        help="Adds per user per group per day, for groups that don't set their own throttle" )
+    return arg_parser.parse_args()
+
+
+def _main():
+    args = _parse_args()
+
+    with open( args.world_json, "r" ) as world_handle:
+        world = json.load( world_handle )
+
+    fake_flickr_api = FakeFlickrApi( world, args.latency_ms, args.latency_jitter_ms, args.error_rate,
+        args.default_group_throttle )
+    ( http_server, rest_url ) = start_fake_flickr_api_server( fake_flickr_api, args.listen_host, args.listen_port )
+
+    print( f"Fake Flickr API listening at {rest_url} (GET /stats for call counts)" )
+    try:
+        while True:
+            time.sleep( 3600 )
+    except KeyboardInterrupt:
+        http_server.shutdown()
+
+
+if __name__ == "__main__":
+    _main()
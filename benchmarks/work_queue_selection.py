@@ -0,0 +1,286 @@
+import argparse
+import json
+import os.path
+import time
+import psycopg2
+
+
+# Run against a scratch database: everything lives in its own schema, which is dropped and recreated
+benchmark_schema = "fga_benchmark"
+
+create_fga_db_sql_filename = os.path.join( os.path.dirname( os.path.abspath(__file__) ), "..", "db",
+    "create_fga_db.sql" )
+
+
+def _parse_args():
+    arg_parser = argparse.ArgumentParser(
+        description="Time the nightly work-queue selection as the attempt history grows" )
+    arg_parser.add_argument( "postgres_creds_json", help="JSON file with DB credentials (use a scratch DB)" )
+    arg_parser.add_argument( "--requests", type=int, default=1000000, help="Number of submitted requests" )
+    arg_parser.add_argument( "--attempts-per-request", default="0,5,15,30",
+        help="Comma-separated history sizes to measure at (attempts per request, e.g. 30 => 30M attempts)" )
+    arg_parser.add_argument( "--actionable-fraction", type=float, default=0.05,
+        help="Fraction of requests that never reach a permstatus_* status" )
+    arg_parser.add_argument( "--repeats", type=int, default=3, help="Timed runs per query, best one is reported" )
+    arg_parser.add_argument( "--legacy-lookup-sample", type=int, default=1000,
+        help="Per-row permanent status lookups to time for the legacy path (extrapolated to all candidates)" )
+    arg_parser.add_argument( "--results-json", default=None, help="Write results to this JSON file" )
+    return arg_parser.parse_args()
+
+
+def _connect_to_db( pgsql_creds ):
+    return psycopg2.connect(
+        host        = pgsql_creds['db_host'],
+        user        = pgsql_creds['db_user'],
+        password    = pgsql_creds['db_passwd'],
+        database    = pgsql_creds['db_dbname'],
+        options     = f"-c search_path={benchmark_schema}" )
+
+
+def _create_schema( db_conn ):
+    with open( create_fga_db_sql_filename, "r" ) as create_sql_handle:
+        create_sql = create_sql_handle.read()
+
+    with db_conn.cursor() as db_cursor:
+        db_cursor.execute( f"DROP SCHEMA IF EXISTS {benchmark_schema} CASCADE;" )
+        db_cursor.execute( f"CREATE SCHEMA {benchmark_schema};" )
+        db_cursor.execute( create_sql )
+
+    db_conn.commit()
+
+
+def _seed_requests( db_conn, request_count ):
+    with db_conn.cursor() as db_cursor:
+        db_cursor.execute( """
+            INSERT INTO submitted_requests( uuid_pk, flickr_user_cognito_id, picture_flickr_id, flickr_group_id,
+                request_datetime )
+            SELECT  md5( 'request_' || i )::uuid,
+                    md5( 'user_' || ( i %% 5000 ) )::uuid,
+                    ( 50000000000 + i / 20 )::varchar,
+                    ( i %% 20 ) || '@N00',
+                    NOW() - ( i || ' seconds' )::interval
+            FROM generate_series( 1, %s ) AS i;
+        """, ( request_count, ) )
+
+    db_conn.commit()
+
+
+def _grow_attempt_history( db_conn, from_attempts_per_request, to_attempts_per_request, actionable_fraction ):
+    # Bulk loading through the per-row trigger would take hours at 30M rows, so load with it disabled
+    # and then rebuild the summary columns in one pass, the same way the migration backfills them.
+    # Day 1 (yesterday) is each request's most recent attempt; permanent requests finished on that day
+    with db_conn.cursor() as db_cursor:
+        db_cursor.execute( "ALTER TABLE group_add_attempts DISABLE TRIGGER group_add_attempts_latest_status_trigger;" )
+
+        db_cursor.execute( """
+            INSERT INTO group_add_attempts( uuid_pk, submitted_request_fk, attempt_started, attempt_completed,
+                final_status )
+            SELECT  md5( submitted_requests.uuid_pk::text || '_' || days_ago )::uuid,
+                    submitted_requests.uuid_pk,
+                    NOW() - ( days_ago || ' days' )::interval,
+                    NOW() - ( days_ago || ' days' )::interval + interval '1 second',
+                    CASE
+                        WHEN days_ago = 1 AND abs( hashtext( submitted_requests.uuid_pk::text ) ) %% 10000 >= %s
+                            THEN 'permstatus_success_added'
+                        ELSE 'defer_group_throttled_for_user'
+                    END
+            FROM submitted_requests
+            CROSS JOIN generate_series( %s, %s ) AS days_ago;
+        """, ( int(actionable_fraction * 10000), from_attempts_per_request + 1, to_attempts_per_request ) )
+
+        db_cursor.execute( """
+            UPDATE submitted_requests
+            SET last_attempt_started    = latest_attempts.most_recent_attempt_started,
+                last_final_status       = latest_attempts.final_status
+            FROM (
+                SELECT DISTINCT ON ( submitted_request_fk )
+                        submitted_request_fk,
+                        MAX(attempt_started) OVER ( PARTITION BY submitted_request_fk ) AS most_recent_attempt_started,
+                        CASE WHEN attempt_completed IS NULL THEN NULL ELSE final_status END AS final_status
+                FROM group_add_attempts
+                ORDER BY submitted_request_fk, attempt_completed DESC NULLS LAST
+            ) AS latest_attempts
+            WHERE submitted_requests.uuid_pk = latest_attempts.submitted_request_fk;
+        """ )
+
+        db_cursor.execute( "ALTER TABLE group_add_attempts ENABLE TRIGGER group_add_attempts_latest_status_trigger;" )
+
+    db_conn.commit()
+
+    # ANALYZE can't run inside a transaction block
+    db_conn.autocommit = True
+    with db_conn.cursor() as db_cursor:
+        db_cursor.execute( "VACUUM ANALYZE submitted_requests;" )
+        db_cursor.execute( "VACUUM ANALYZE group_add_attempts;" )
+    db_conn.autocommit = False
+
+
+def _time_query( db_conn, sql_command, repeats ):
+    best_seconds = None
+    row_count = 0
+    with db_conn.cursor() as db_cursor:
+        for _ in range( repeats ):
+            start_time = time.perf_counter()
+            db_cursor.execute( sql_command )
+            rows = db_cursor.fetchall()
+            elapsed_seconds = time.perf_counter() - start_time
+
+            row_count = len( rows )
+            if best_seconds is None or elapsed_seconds < best_seconds:
+                best_seconds = elapsed_seconds
+
+    db_conn.rollback()
+
+    return { 'seconds': best_seconds, 'rows': row_count }
+
+
+def _time_legacy_selection( db_conn, repeats, lookup_sample ):
+    # The query add_images_to_groups.py used before the summary columns existed, followed by one
+    # "most recent status" lookup per candidate row
+    legacy_results = _time_query( db_conn, """
+        SELECT      inner_query.user_submitted_request_id,
+                    submitted_requests.flickr_user_cognito_id,
+                    submitted_requests.picture_flickr_id,
+                    submitted_requests.flickr_group_id
+        FROM (
+            SELECT  submitted_requests.uuid_pk AS user_submitted_request_id,
+                    DATE(MAX(attempt_started)) AS most_recent_attempt_date
+            FROM submitted_requests
+            LEFT JOIN group_add_attempts
+            ON submitted_requests.uuid_pk = group_add_attempts.submitted_request_fk
+            GROUP BY submitted_requests.uuid_pk
+        ) AS inner_query
+        JOIN submitted_requests
+        ON inner_query.user_submitted_request_id = submitted_requests.uuid_pk
+        WHERE inner_query.most_recent_attempt_date IS NULL
+            OR (inner_query.most_recent_attempt_date <> date(now()))
+        ORDER BY submitted_requests.request_datetime;
+    """, repeats )
+
+    with db_conn.cursor() as db_cursor:
+        db_cursor.execute( "SELECT uuid_pk FROM submitted_requests ORDER BY random() LIMIT %s;", ( lookup_sample, ) )
+        sample_request_ids = [ curr_row[0] for curr_row in db_cursor.fetchall() ]
+
+        start_time = time.perf_counter()
+        for request_id in sample_request_ids:
+            db_cursor.execute( """
+                SELECT final_status
+                FROM group_add_attempts
+                WHERE submitted_request_fk = %s
+                ORDER BY attempt_completed DESC
+                LIMIT 1;
+            """, ( request_id, ) )
+            db_cursor.fetchone()
+        lookup_seconds = time.perf_counter() - start_time
+
+    db_conn.rollback()
+
+    if sample_request_ids:
+        legacy_results['per_row_lookup_seconds'] = \
+            lookup_seconds / len( sample_request_ids ) * legacy_results['rows']
+    else:
+        legacy_results['per_row_lookup_seconds'] = 0.0
+
+    legacy_results['total_seconds'] = legacy_results['seconds'] + legacy_results['per_row_lookup_seconds']
+
+    return legacy_results
+
+
+def _time_current_selection( db_conn, repeats ):
+    current_results = _time_query( db_conn, """
+        SELECT      uuid_pk,
+                    flickr_user_cognito_id,
+                    picture_flickr_id,
+                    flickr_group_id
+        FROM submitted_requests
+        WHERE has_permanent_status = FALSE
+            AND ( last_attempt_started IS NULL OR DATE(last_attempt_started) <> DATE(NOW()) )
+        ORDER BY request_datetime;
+    """, repeats )
+
+    current_results['total_seconds'] = current_results['seconds']
+
+    return current_results
+
+
+def _time_current_fair_share_selection( db_conn, repeats ):
+    # The default --request-order; ranks every actionable row per user, so it sorts the whole actionable
+    # set rather than walking the index
+    fair_share_results = _time_query( db_conn, """
+        SELECT      uuid_pk,
+                    flickr_user_cognito_id,
+                    picture_flickr_id,
+                    flickr_group_id
+        FROM (
+            SELECT  uuid_pk,
+                    flickr_user_cognito_id,
+                    picture_flickr_id,
+                    flickr_group_id,
+                    request_datetime,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY flickr_user_cognito_id ORDER BY request_datetime ) AS user_request_rank
+            FROM submitted_requests
+            WHERE has_permanent_status = FALSE
+                AND ( last_attempt_started IS NULL OR DATE(last_attempt_started) <> DATE(NOW()) )
+        ) AS actionable_requests
+        ORDER BY user_request_rank, request_datetime;
+    """, repeats )
+
+    fair_share_results['total_seconds'] = fair_share_results['seconds']
+
+    return fair_share_results
+
+
+def _main():
+    args = _parse_args()
+
+    with open( args.postgres_creds_json, "r" ) as pgsql_creds_handle:
+        pgsql_creds = json.load( pgsql_creds_handle )
+
+    history_sizes = [ int(curr_size) for curr_size in args.attempts_per_request.split(",") ]
+
+    results = {
+        'requests'              : args.requests,
+        'actionable_fraction'   : args.actionable_fraction,
+        'measurements'          : [],
+    }
+
+    db_conn = _connect_to_db( pgsql_creds )
+    try:
+        print( f"Creating schema {benchmark_schema} and seeding {args.requests} requests" )
+        _create_schema( db_conn )
+        _seed_requests( db_conn, args.requests )
+
+        attempts_per_request = 0
+        for history_size in sorted( history_sizes ):
+            if history_size > attempts_per_request:
+                print( f"Growing attempt history to {history_size} attempts per request" )
+                _grow_attempt_history( db_conn, attempts_per_request, history_size, args.actionable_fraction )
+                attempts_per_request = history_size
+
+            measurement = {
+                'attempts_per_request'  : attempts_per_request,
+                'total_attempts'        : attempts_per_request * args.requests,
+                'legacy'                : _time_legacy_selection( db_conn, args.repeats, args.legacy_lookup_sample ),
+                'current'               : _time_current_selection( db_conn, args.repeats ),
+                'current_fair_share'    : _time_current_fair_share_selection( db_conn, args.repeats ),
+            }
+            results['measurements'].append( measurement )
+
+            print( f"\t{measurement['total_attempts']:>12,d} attempts: " +
+                f"legacy {measurement['legacy']['total_seconds']:8.3f}s ({measurement['legacy']['rows']} rows), " +
+                f"current {measurement['current']['total_seconds']:8.3f}s ({measurement['current']['rows']} rows), " +
+                f"current fair_share {measurement['current_fair_share']['total_seconds']:8.3f}s " +
+                f"({measurement['current_fair_share']['rows']} rows)" )
+    finally:
+        db_conn.close()
+
+    print( "\nResults:\n" + json.dumps(results, indent=4, sort_keys=True) )
+
+    if args.results_json is not None:
+        with open( args.results_json, "w" ) as results_handle:
+            json.dump( results, results_handle, indent=4, sort_keys=True )
+
+
+if __name__ == "__main__":
+    _main()
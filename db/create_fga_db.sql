@@ -1,5 +1,7 @@
-DROP TABLE group_add_attempts;
-DROP TABLE submitted_requests;
+DROP TABLE IF EXISTS api_call_reservations;
+DROP TABLE IF EXISTS group_throttles;
+DROP TABLE IF EXISTS group_add_attempts;
+DROP TABLE IF EXISTS submitted_requests;
 
 CREATE TABLE submitted_requests (
     uuid_pk                 UUID PRIMARY KEY,
@@ -7,12 +9,29 @@ CREATE TABLE submitted_requests (
     picture_flickr_id       VARCHAR NOT NULL,
     flickr_group_id         VARCHAR NOT NULL,
     request_datetime        TIMESTAMP WITH TIME ZONE NOT NULL,
+
+    -- Maintained by the group_add_attempts trigger below so the nightly run can decide what is
+    -- actionable without touching the attempt history
+    last_attempt_started    TIMESTAMP WITH TIME ZONE,
+    last_final_status       VARCHAR,
+    has_permanent_status    BOOLEAN NOT NULL GENERATED ALWAYS AS (
+                                COALESCE( last_final_status LIKE 'permstatus\_%', FALSE ) ) STORED,
+
+    -- Set while a worker running with --lease-requests holds this request; expired leases are up for grabs
+    lease_owner             VARCHAR,
+    lease_expires           TIMESTAMP WITH TIME ZONE,
     
     UNIQUE (flickr_user_cognito_id, picture_flickr_id, flickr_group_id)
 );
 
 CREATE INDEX submitted_requests_user_idx        ON submitted_requests (flickr_user_cognito_id);
 CREATE INDEX submitted_requests_datetime_idx    ON submitted_requests (request_datetime);
+CREATE INDEX submitted_requests_actionable_idx  ON submitted_requests (request_datetime, last_attempt_started)
+    WHERE has_permanent_status = FALSE;
+CREATE INDEX submitted_requests_lease_owner_idx ON submitted_requests (lease_owner)
+    WHERE lease_owner IS NOT NULL;
+CREATE INDEX submitted_requests_user_actionable_idx ON submitted_requests (flickr_user_cognito_id, request_datetime)
+    WHERE has_permanent_status = FALSE;
 
 CREATE TABLE group_add_attempts (
     uuid_pk                 UUID PRIMARY KEY,
@@ -24,3 +43,63 @@ CREATE TABLE group_add_attempts (
 
 CREATE INDEX group_add_attempt_submitted_request_idx    ON group_add_attempts( submitted_request_fk );
 CREATE INDEX group_add_attempt_final_status_idx         ON group_add_attempts( final_status );
+CREATE INDEX group_add_attempt_request_completed_idx    ON group_add_attempts( submitted_request_fk, attempt_completed );
+
+CREATE OR REPLACE FUNCTION refresh_submitted_request_latest_status() RETURNS TRIGGER AS $$
+BEGIN
+    -- A new attempt or a completion only ever moves the summary forward, so it's updated from the row
+    -- itself. Only a DELETE (a claim handed back unattempted) can move it back, so that's the one case
+    -- that goes back to the request's attempt history
+    IF TG_OP = 'DELETE' THEN
+        UPDATE submitted_requests
+        SET last_attempt_started = (
+                SELECT MAX(attempt_started)
+                FROM group_add_attempts
+                WHERE submitted_request_fk = OLD.submitted_request_fk ),
+            last_final_status = (
+                SELECT final_status
+                FROM group_add_attempts
+                WHERE submitted_request_fk = OLD.submitted_request_fk
+                    AND attempt_completed IS NOT NULL
+                ORDER BY attempt_completed DESC
+                LIMIT 1 )
+        WHERE uuid_pk = OLD.submitted_request_fk;
+    ELSE
+        UPDATE submitted_requests
+        SET last_attempt_started = GREATEST( last_attempt_started, NEW.attempt_started ),
+            last_final_status = CASE
+                WHEN NEW.attempt_completed IS NOT NULL THEN NEW.final_status
+                ELSE last_final_status
+            END
+        WHERE uuid_pk = NEW.submitted_request_fk;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER group_add_attempts_latest_status_trigger
+    AFTER INSERT OR UPDATE OR DELETE ON group_add_attempts
+    FOR EACH ROW EXECUTE FUNCTION refresh_submitted_request_latest_status();
+
+CREATE TABLE group_throttles (
+    flickr_user_cognito_id  UUID NOT NULL,
+    flickr_group_id         VARCHAR NOT NULL,
+    throttle_date           DATE NOT NULL,
+    throttle_recorded       TIMESTAMP WITH TIME ZONE NOT NULL,
+
+    PRIMARY KEY (flickr_user_cognito_id, flickr_group_id, throttle_date)
+);
+
+CREATE INDEX group_throttles_date_idx   ON group_throttles( throttle_date );
+
+-- Blocks of API calls reserved by workers running with --lease-requests, so they all share the API key's
+-- hourly budget; rows older than an hour no longer count and are deleted by the next reservation
+CREATE TABLE api_call_reservations (
+    uuid_pk                 UUID PRIMARY KEY,
+    api_key                 VARCHAR NOT NULL,
+    reserved_at             TIMESTAMP WITH TIME ZONE NOT NULL,
+    call_count              INTEGER NOT NULL
+);
+
+CREATE INDEX api_call_reservations_key_time_idx ON api_call_reservations( api_key, reserved_at );
@@ -0,0 +1,70 @@
+-- Adds the latest-attempt summary columns to submitted_requests, backfills them from the existing
+-- attempt history, and installs the trigger that keeps them current. Safe to run once against a
+-- database created from an older create_fga_db.sql.
+
+BEGIN;
+
+ALTER TABLE submitted_requests
+    ADD COLUMN last_attempt_started TIMESTAMP WITH TIME ZONE,
+    ADD COLUMN last_final_status    VARCHAR;
+
+UPDATE submitted_requests
+SET last_attempt_started    = latest_attempts.most_recent_attempt_started,
+    last_final_status       = latest_attempts.final_status
+FROM (
+    SELECT DISTINCT ON ( submitted_request_fk )
+            submitted_request_fk,
+            MAX(attempt_started) OVER ( PARTITION BY submitted_request_fk ) AS most_recent_attempt_started,
+            CASE WHEN attempt_completed IS NULL THEN NULL ELSE final_status END AS final_status
+    FROM group_add_attempts
+    ORDER BY submitted_request_fk, attempt_completed DESC NULLS LAST
+) AS latest_attempts
+WHERE submitted_requests.uuid_pk = latest_attempts.submitted_request_fk;
+
+ALTER TABLE submitted_requests
+    ADD COLUMN has_permanent_status BOOLEAN NOT NULL GENERATED ALWAYS AS (
+        COALESCE( last_final_status LIKE 'permstatus\_%', FALSE ) ) STORED;
+
+CREATE INDEX submitted_requests_actionable_idx  ON submitted_requests (request_datetime, last_attempt_started)
+    WHERE has_permanent_status = FALSE;
+
+CREATE INDEX group_add_attempt_request_completed_idx    ON group_add_attempts( submitted_request_fk, attempt_completed );
+
+CREATE OR REPLACE FUNCTION refresh_submitted_request_latest_status() RETURNS TRIGGER AS $$
+BEGIN
+    -- A new attempt or a completion only ever moves the summary forward, so it's updated from the row
+    -- itself. Only a DELETE (a claim handed back unattempted) can move it back, so that's the one case
+    -- that goes back to the request's attempt history
+    IF TG_OP = 'DELETE' THEN
+        UPDATE submitted_requests
+        SET last_attempt_started = (
+                SELECT MAX(attempt_started)
+                FROM group_add_attempts
+                WHERE submitted_request_fk = OLD.submitted_request_fk ),
+            last_final_status = (
+                SELECT final_status
+                FROM group_add_attempts
+                WHERE submitted_request_fk = OLD.submitted_request_fk
+                    AND attempt_completed IS NOT NULL
+                ORDER BY attempt_completed DESC
+                LIMIT 1 )
+        WHERE uuid_pk = OLD.submitted_request_fk;
+    ELSE
+        UPDATE submitted_requests
+        SET last_attempt_started = GREATEST( last_attempt_started, NEW.attempt_started ),
+            last_final_status = CASE
+                WHEN NEW.attempt_completed IS NOT NULL THEN NEW.final_status
+                ELSE last_final_status
+            END
+        WHERE uuid_pk = NEW.submitted_request_fk;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER group_add_attempts_latest_status_trigger
+    AFTER INSERT OR UPDATE OR DELETE ON group_add_attempts
+    FOR EACH ROW EXECUTE FUNCTION refresh_submitted_request_latest_status();
+
+COMMIT;
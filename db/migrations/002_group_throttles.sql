@@ -0,0 +1,17 @@
+-- Adds the per-day record of groups that have hit their add throttle for a user, so later requests
+-- for the same user and group are deferred without calling Flickr.
+
+BEGIN;
+
+CREATE TABLE group_throttles (
+    flickr_user_cognito_id  UUID NOT NULL,
+    flickr_group_id         VARCHAR NOT NULL,
+    throttle_date           DATE NOT NULL,
+    throttle_recorded       TIMESTAMP WITH TIME ZONE NOT NULL,
+
+    PRIMARY KEY (flickr_user_cognito_id, flickr_group_id, throttle_date)
+);
+
+CREATE INDEX group_throttles_date_idx   ON group_throttles( throttle_date );
+
+COMMIT;
@@ -0,0 +1,12 @@
+-- Adds the lease columns used when several add_images_to_groups.py workers run with --lease-requests.
+
+BEGIN;
+
+ALTER TABLE submitted_requests
+    ADD COLUMN lease_owner      VARCHAR,
+    ADD COLUMN lease_expires    TIMESTAMP WITH TIME ZONE;
+
+CREATE INDEX submitted_requests_lease_owner_idx ON submitted_requests (lease_owner)
+    WHERE lease_owner IS NOT NULL;
+
+COMMIT;
@@ -0,0 +1,18 @@
+-- Adds the per-user index fair_share lease claims walk, and the table leasing workers reserve API calls
+-- from so they share one hourly budget.
+
+BEGIN;
+
+CREATE INDEX submitted_requests_user_actionable_idx ON submitted_requests (flickr_user_cognito_id, request_datetime)
+    WHERE has_permanent_status = FALSE;
+
+CREATE TABLE api_call_reservations (
+    uuid_pk                 UUID PRIMARY KEY,
+    api_key                 VARCHAR NOT NULL,
+    reserved_at             TIMESTAMP WITH TIME ZONE NOT NULL,
+    call_count              INTEGER NOT NULL
+);
+
+CREATE INDEX api_call_reservations_key_time_idx ON api_call_reservations( api_key, reserved_at );
+
+COMMIT;
@@ -0,0 +1,40 @@
+-- Replaces the latest-status trigger function installed by older copies of migration 001, which re-read
+-- the request's whole attempt history on every attempt INSERT and UPDATE. Inserts and completions now
+-- update the summary from the new row; only a DELETE recomputes it. Safe to run more than once.
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION refresh_submitted_request_latest_status() RETURNS TRIGGER AS $$
+BEGIN
+    -- A new attempt or a completion only ever moves the summary forward, so it's updated from the row
+    -- itself. Only a DELETE (a claim handed back unattempted) can move it back, so that's the one case
+    -- that goes back to the request's attempt history
+    IF TG_OP = 'DELETE' THEN
+        UPDATE submitted_requests
+        SET last_attempt_started = (
+                SELECT MAX(attempt_started)
+                FROM group_add_attempts
+                WHERE submitted_request_fk = OLD.submitted_request_fk ),
+            last_final_status = (
+                SELECT final_status
+                FROM group_add_attempts
+                WHERE submitted_request_fk = OLD.submitted_request_fk
+                    AND attempt_completed IS NOT NULL
+                ORDER BY attempt_completed DESC
+                LIMIT 1 )
+        WHERE uuid_pk = OLD.submitted_request_fk;
+    ELSE
+        UPDATE submitted_requests
+        SET last_attempt_started = GREATEST( last_attempt_started, NEW.attempt_started ),
+            last_final_status = CASE
+                WHEN NEW.attempt_completed IS NOT NULL THEN NEW.final_status
+                ELSE last_final_status
+            END
+        WHERE uuid_pk = NEW.submitted_request_fk;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+COMMIT;
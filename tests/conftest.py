@@ -0,0 +1,9 @@
+import os.path
+import sys
+
+
+# The scripts aren't a package; import them the same way running them from their own directory would
+repo_dir = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) )
+for script_dir in ( os.path.join(repo_dir, "venv", "Scripts"), os.path.join(repo_dir, "benchmarks") ):
+    if script_dir not in sys.path:
+        sys.path.insert( 0, script_dir )
@@ -0,0 +1,307 @@
+import argparse
+import json
+import pytest
+
+import add_images_to_groups
+import fake_flickr_api
+import fga_lookup_cache
+import fga_metrics
+
+
+user_oauth_token    = "token-1"
+user_nsid           = "1@N00"
+user_cognito_id     = "00000000-0000-0000-0000-000000000001"
+
+
+class _StubAttemptJournal:
+    """
+    Stands in for _AttemptJournal without a database: every claim succeeds and final statuses are kept
+    in memory, keyed by request ID.
+    """
+
+    flush_batch_size = 100
+
+    def __init__( self ):
+        self.final_statuses     = {}
+        self.released_attempts  = []
+        self.group_throttles    = []
+
+    def claim_requests( self, user_requests ):
+        return { user_request_details['request_id']: f"attempt-{user_request_details['request_id']}"
+            for user_request_details in user_requests }
+
+    def record_completion( self, add_attempt_guid, final_status ):
+        self.final_statuses[ add_attempt_guid[len("attempt-"):] ] = final_status
+
+    def release_claims( self, add_attempt_guids ):
+        self.released_attempts.extend( add_attempt_guids )
+
+    def record_group_throttle( self, user_cognito_id, group_id, throttle_date ):
+        self.group_throttles.append( (user_cognito_id, group_id, throttle_date) )
+
+    def flush( self ):
+        pass
+
+
+class _StubSharedApiCallBudget:
+    """
+    Stands in for _SharedApiCallBudget without a database: a fixed number of calls for everyone sharing it.
+    """
+
+    def __init__( self, calls_left ):
+        self.calls_left = calls_left
+
+    def take_call( self, call_type ):
+        if self.calls_left == 0:
+            return False
+
+        self.calls_left -= 1
+        return True
+
+
+def _build_world():
+    return {
+        'users': {
+            user_oauth_token: {
+                'nsid'      : user_nsid,
+                'groups'    : [ "open@N00", "throttled@N00", "moderated@N00" ],
+            },
+        },
+        'groups': {
+            "open@N00"          : { 'name': "Open" },
+            "throttled@N00"     : { 'name': "Throttled", 'throttle': 0 },
+            "moderated@N00"     : { 'name': "Moderated", 'moderated': True },
+            "not_joined@N00"    : { 'name': "Not joined" },
+        },
+        'photos': {
+            photo_id: { 'owner_token': user_oauth_token, 'pools': [] } for photo_id in ( "1001", "1002", "1003" )
+        },
+    }
+
+
+@pytest.fixture
+def fake_flickr( request ):
+    error_rate = getattr( request, "param", 0.0 )
+    flickr_api = fake_flickr_api.FakeFlickrApi( _build_world(), error_rate=error_rate, random_seed=1 )
+    ( http_server, rest_url ) = fake_flickr_api.start_fake_flickr_api_server( flickr_api )
+
+    yield ( flickr_api, rest_url )
+
+    http_server.shutdown()
+    http_server.server_close()
+
+
+@pytest.fixture
+def lookup_cache_filename( tmp_path ):
+    return str( tmp_path / "lookup_cache.sqlite3" )
+
+
+app_flickr_api_key_info = {
+    'api_key'           : "test-api-key",
+    'api_key_secret'    : "test-api-key-secret",
+}
+
+user_flickr_auth_info = {
+    'user_oauth_token'          : user_oauth_token,
+    'user_oauth_token_secret'   : f"{user_oauth_token}-secret",
+    'user_fullname'             : "Test User",
+    'username'                  : "test_user",
+    'user_nsid'                 : user_nsid,
+}
+
+
+def _create_flickr_api_handle( rest_url, api_scheduler ):
+    return add_images_to_groups._create_flickr_api_handle( argparse.Namespace(flickr_api_rest_url=rest_url),
+        app_flickr_api_key_info, user_flickr_auth_info, api_scheduler )
+
+
+def _make_request( request_id, picture_id, group_id, request_user_cognito_id=user_cognito_id ):
+    return {
+        'request_id'                : request_id,
+        'request_user_cognito_id'   : request_user_cognito_id,
+        'request_flickr_picture_id' : picture_id,
+        'request_flickr_group_id'   : group_id,
+    }
+
+
+def _process_requests( rest_url, lookup_cache, user_requests ):
+    api_scheduler = add_images_to_groups._ApiCallScheduler( None, 0.2 )
+    attempt_journal = _StubAttemptJournal()
+    stats = add_images_to_groups._new_stats()
+
+    add_images_to_groups._process_user_requests( _create_flickr_api_handle(rest_url, api_scheduler), user_nsid,
+        lookup_cache, attempt_journal, add_images_to_groups._GroupThrottleRegistry(), api_scheduler, user_requests,
+        {}, {}, stats )
+
+    return ( attempt_journal, stats )
+
+
+def _pool_add_call_errors():
+    return fga_metrics.run_metrics._counters.get( ("fga_flickr_call_errors_total", "method", "groups.pools.add"), 0 )
+
+
+def test_add_outcomes( fake_flickr, lookup_cache_filename ):
+    ( flickr_api, rest_url ) = fake_flickr
+    lookup_cache = fga_lookup_cache.LookupCache( lookup_cache_filename, 3600, 1000 )
+    pool_add_call_errors_before = _pool_add_call_errors()
+
+    ( attempt_journal, stats ) = _process_requests( rest_url, lookup_cache, [
+        _make_request( "added", "1001", "open@N00" ),
+        _make_request( "throttled", "1001", "throttled@N00" ),
+        _make_request( "throttled_again", "1002", "throttled@N00" ),
+        _make_request( "queued", "1002", "moderated@N00" ),
+        _make_request( "not_in_group", "1003", "not_joined@N00" ),
+        _make_request( "already_in_group", "1001", "open@N00" ),
+    ] )
+
+    assert attempt_journal.final_statuses == {
+        'added'             : "permstatus_success_added",
+        'throttled'         : "defer_group_throttled_for_user",
+        'throttled_again'   : "defer_group_throttled_for_user",
+        'queued'            : "permstatus_success_added_queued",
+        'not_in_group'      : "permstatus_fail_user_not_in_flickr_group",
+        'already_in_group'  : "permstatus_success_pic_already_in_group",
+    }
+
+    # Error 5 is remembered for the rest of the day, so the second request never reaches Flickr
+    assert stats['throttle_api_calls_avoided'] == 1
+    assert [ (throttled_user, throttled_group) for (throttled_user, throttled_group, _) in
+        attempt_journal.group_throttles ] == [ (user_cognito_id, "throttled@N00") ]
+    assert flickr_api.get_stats()['calls_per_method']['flickr.groups.pools.add'] == 3
+
+    # Error 5 and Error 6 are outcomes, not failed calls
+    assert _pool_add_call_errors() == pool_add_call_errors_before
+
+    assert stats['attempted_success'] == 2
+    assert stats['skipped_already_added'] == 1
+    assert stats['deferred'] == 2
+    assert stats['attempted_fail'] == 1
+
+
+@pytest.mark.parametrize( "fake_flickr", [ 1.0 ], indirect=True )
+def test_lookup_errors_fail_only_their_request( fake_flickr, lookup_cache_filename ):
+    ( flickr_api, rest_url ) = fake_flickr
+    lookup_cache = fga_lookup_cache.LookupCache( lookup_cache_filename, 3600, 1000 )
+
+    # Every call answers Error 105; each request gets a retryable failure and the run carries on
+    ( attempt_journal, stats ) = _process_requests( rest_url, lookup_cache, [
+        _make_request( "first", "1001", "open@N00" ),
+        _make_request( "second", "1002", "open@N00" ),
+    ] )
+
+    assert set( attempt_journal.final_statuses ) == { "first", "second" }
+    for final_status in attempt_journal.final_statuses.values():
+        assert final_status.startswith( "fail_Error: 105:" )
+
+    assert stats['attempted_fail'] == 2
+    assert attempt_journal.released_attempts == []
+
+
+def test_stale_cached_group_list_is_refetched( fake_flickr, lookup_cache_filename ):
+    ( flickr_api, rest_url ) = fake_flickr
+
+    # An earlier run cached the user's group list from before they joined any groups
+    earlier_lookup_cache = fga_lookup_cache.LookupCache( lookup_cache_filename, 3600, 1000 )
+    earlier_lookup_cache.get_or_fetch( "user_groups", user_nsid, lambda: [] )
+    earlier_lookup_cache.close()
+
+    lookup_cache = fga_lookup_cache.LookupCache( lookup_cache_filename, 3600, 1000 )
+    ( attempt_journal, stats ) = _process_requests( rest_url, lookup_cache, [
+        _make_request( "joined_since", "1001", "open@N00" ),
+    ] )
+
+    assert attempt_journal.final_statuses == { 'joined_since': "permstatus_success_added" }
+    assert lookup_cache.get_stats()['refetches'] == 1
+
+
+def test_per_user_workers_outlive_batches( fake_flickr, lookup_cache_filename, tmp_path ):
+    ( flickr_api, rest_url ) = fake_flickr
+    with open( tmp_path / f"{user_cognito_id}.json", "w" ) as user_auth_info_handle:
+        json.dump( user_flickr_auth_info, user_auth_info_handle )
+
+    args = argparse.Namespace( flickr_api_rest_url=rest_url, user_auth_info_dir=str(tmp_path),
+        max_concurrent_requests=4, max_concurrent_requests_per_user=2, batch_size=2 )
+    api_scheduler = add_images_to_groups._ApiCallScheduler( None, 0.2 )
+    attempt_journal = _StubAttemptJournal()
+    lookup_cache = fga_lookup_cache.LookupCache( lookup_cache_filename, 3600, 1000 )
+    per_user_dispatcher = add_images_to_groups._PerUserDispatcher( args, app_flickr_api_key_info, lookup_cache,
+        add_images_to_groups._GroupThrottleRegistry(), api_scheduler, attempt_journal )
+
+    unknown_user_cognito_id = "00000000-0000-0000-0000-000000000002"
+    per_user_dispatcher.dispatch( [
+        _make_request( "first", "1001", "open@N00" ),
+        _make_request( "no_auth_info", "2001", "open@N00", unknown_user_cognito_id ),
+    ] )
+    per_user_dispatcher.dispatch( [
+        _make_request( "second", "1002", "open@N00" ),
+        _make_request( "third", "1003", "moderated@N00" ),
+        _make_request( "no_auth_info_again", "2002", "open@N00", unknown_user_cognito_id ),
+    ] )
+    stats = per_user_dispatcher.finish()
+
+    assert attempt_journal.final_statuses == {
+        'first'     : "permstatus_success_added",
+        'second'    : "permstatus_success_added",
+        'third'     : "permstatus_success_added_queued",
+    }
+
+    # One worker per user for the whole run: the group list is fetched once, not once per batch
+    assert flickr_api.get_stats()['calls_per_method']['flickr.groups.pools.getGroups'] == 1
+    assert stats['users_failed'] == 1
+    assert stats['left_for_next_run'] == 2
+
+
+@pytest.fixture
+def fake_clock( monkeypatch ):
+    fake_time = [ 0.0 ]
+    monkeypatch.setattr( add_images_to_groups.time, "monotonic", lambda: fake_time[0] )
+    return fake_time
+
+
+def test_write_reserve_outlasts_lookups( fake_clock ):
+    api_scheduler = add_images_to_groups._ApiCallScheduler( 100, 0.2 )
+
+    for _ in range( 80 ):
+        api_scheduler.acquire( "photos.getAllContexts" )
+
+    with pytest.raises( add_images_to_groups._ApiBudgetExhausted ):
+        api_scheduler.acquire( "photos.getAllContexts" )
+
+    # No new requests start, but the adds of requests already past their lookups still get through
+    assert api_scheduler.is_exhausted()
+    for _ in range( 20 ):
+        api_scheduler.acquire( "groups.pools.add" )
+
+    with pytest.raises( add_images_to_groups._ApiBudgetExhausted ):
+        api_scheduler.acquire( "groups.pools.add" )
+
+    assert api_scheduler.get_calls_made() == { 'lookup': 80, 'write': 20 }
+
+
+def test_budget_holds_over_a_trailing_hour( fake_clock ):
+    api_scheduler = add_images_to_groups._ApiCallScheduler( 3600, 0.0 )
+
+    # Twice as fast as the budget allows: the hour's calls must run out half way through it
+    calls_made = 0
+    with pytest.raises( add_images_to_groups._ApiBudgetExhausted ):
+        while fake_clock[0] < 3600:
+            api_scheduler.acquire( "groups.pools.add" )
+            calls_made += 1
+            fake_clock[0] += 0.5
+
+    assert calls_made == 3600
+    assert fake_clock[0] == 1800
+
+
+def test_workers_share_one_budget( fake_clock ):
+    shared_api_budget = _StubSharedApiCallBudget( 100 )
+    api_schedulers = [ add_images_to_groups._ApiCallScheduler( 100, 0.0, shared_api_budget ) for _ in range(2) ]
+
+    # Each worker is well within its own hourly limit, but together they've used the key's whole budget
+    for _ in range( 50 ):
+        for api_scheduler in api_schedulers:
+            api_scheduler.acquire( "groups.pools.add" )
+
+    for api_scheduler in api_schedulers:
+        with pytest.raises( add_images_to_groups._ApiBudgetExhausted ):
+            api_scheduler.acquire( "groups.pools.add" )
@@ -0,0 +1,87 @@
+import pytest
+
+import fga_lookup_cache
+
+
+@pytest.fixture
+def fake_clock( monkeypatch ):
+    fake_time = [ 1000.0 ]
+    monkeypatch.setattr( fga_lookup_cache.time, "time", lambda: fake_time[0] )
+    return fake_time
+
+
+@pytest.fixture
+def lookup_cache_filename( tmp_path ):
+    return str( tmp_path / "lookup_cache.sqlite3" )
+
+
+class _CountingFetcher:
+    # Stands in for a Flickr lookup; returns a new value every time so refetches are visible
+    def __init__( self ):
+        self.fetch_count = 0
+
+    def __call__( self ):
+        self.fetch_count += 1
+        return { 'fetch': self.fetch_count }
+
+
+def test_entries_expire_after_ttl( fake_clock, lookup_cache_filename ):
+    lookup_cache = fga_lookup_cache.LookupCache( lookup_cache_filename, 60, 100 )
+    fetcher = _CountingFetcher()
+
+    assert lookup_cache.get_or_fetch( "pic_groups", "1001", fetcher ) == { 'fetch': 1 }
+
+    fake_clock[0] += 59
+    assert lookup_cache.get_or_fetch( "pic_groups", "1001", fetcher ) == { 'fetch': 1 }
+
+    fake_clock[0] += 1
+    assert lookup_cache.get_or_fetch( "pic_groups", "1001", fetcher ) == { 'fetch': 2 }
+
+    assert lookup_cache.get_stats()['hits'] == 1
+    assert lookup_cache.get_stats()['misses'] == 2
+
+
+def test_least_recently_used_entries_are_evicted( fake_clock, lookup_cache_filename ):
+    lookup_cache = fga_lookup_cache.LookupCache( lookup_cache_filename, 3600, 2 )
+
+    for pic_id in ( "1001", "1002" ):
+        lookup_cache.get_or_fetch( "pic_groups", pic_id, _CountingFetcher() )
+        fake_clock[0] += 1
+
+    # Reading 1001 again makes 1002 the least recently used when a third entry arrives
+    lookup_cache.get_or_fetch( "pic_groups", "1001", _CountingFetcher() )
+    fake_clock[0] += 1
+    lookup_cache.get_or_fetch( "pic_groups", "1003", _CountingFetcher() )
+
+    assert lookup_cache.get_stats()['evictions'] == 1
+
+    for ( pic_id, expected_fetch_count ) in ( ("1001", 0), ("1003", 0), ("1002", 1) ):
+        fetcher = _CountingFetcher()
+        lookup_cache.get_or_fetch( "pic_groups", pic_id, fetcher )
+        assert fetcher.fetch_count == expected_fetch_count
+
+
+def test_write_through_keeps_original_expiry( fake_clock, lookup_cache_filename ):
+    lookup_cache = fga_lookup_cache.LookupCache( lookup_cache_filename, 60, 100 )
+    fetcher = _CountingFetcher()
+
+    lookup_cache.get_or_fetch( "pic_groups", "1001", fetcher )
+
+    def _add_group( group_memberships ):
+        group_memberships[ "open@N00" ] = { 'id': "open@N00" }
+        return group_memberships
+
+    fake_clock[0] += 30
+    lookup_cache.update_if_cached( "pic_groups", "1001", _add_group )
+    assert lookup_cache.get_or_fetch( "pic_groups", "1001", fetcher ) == {
+        'fetch'     : 1,
+        'open@N00'  : { 'id': "open@N00" },
+    }
+
+    # Nothing cached, nothing to update
+    lookup_cache.update_if_cached( "pic_groups", "1002", _add_group )
+    assert lookup_cache.get_stats()['write_throughs'] == 1
+
+    # Still refreshed from Flickr when the original fetch expires
+    fake_clock[0] += 30
+    assert lookup_cache.get_or_fetch( "pic_groups", "1001", fetcher ) == { 'fetch': 2 }
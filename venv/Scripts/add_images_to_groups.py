@@ -0,0 +1,1531 @@
+import json
+import argparse
+import pprint
+import flickrapi
+import flickrapi.auth
+import os.path
+import datetime
+import glob
+import psycopg2
+import psycopg2.extras
+import uuid
+import concurrent.futures
+import collections
+import threading
+import socket
+import time
+import fga_lookup_cache
+import fga_metrics
+
+
+def _create_flickr_api_handle( args, app_flickr_api_key_info, user_flickr_auth_info, api_scheduler ):
+    # Create an OAuth User Token that flickr API library understands
+    api_access_level = "write"
+    flickrapi_user_token = flickrapi.auth.FlickrAccessToken(
+        user_flickr_auth_info['user_oauth_token'],
+        user_flickr_auth_info['user_oauth_token_secret'],
+        api_access_level,
+        user_flickr_auth_info['user_fullname'],
+        user_flickr_auth_info['username'],
+        user_flickr_auth_info['user_nsid'])
+
+    flickrapi_handle = flickrapi.FlickrAPI(app_flickr_api_key_info['api_key'],
+                                           app_flickr_api_key_info['api_key_secret'],
+                                           token=flickrapi_user_token,
+                                           store_token=False,
+                                           format='parsed-json')
+
+    # e.g. benchmarks/fake_flickr_api.py instead of the real service
+    if args.flickr_api_rest_url is not None:
+        flickrapi_handle.REST_URL = args.flickr_api_rest_url
+
+    # Every API call made through this handle has to get past the run's call budget first
+    return _ScheduledFlickrApi( flickrapi_handle, api_scheduler )
+
+
+class _ApiBudgetExhausted( Exception ):
+    pass
+
+
+class _ApiCallScheduler:
+    """
+    Holds the API key's calls-per-hour budget, shared by every Flickr handle in the run.
+
+    Calls are counted over a trailing one-hour window, so no hour of the run makes more than calls_per_hour
+    of them. Lookups (getAllContexts, getGroups) may not use the last write_reserve_fraction of the budget,
+    which is kept for groups.pools.add. Once a lookup is refused, is_exhausted() tells callers not to start
+    any more requests, but requests that already made it through their lookups can still make their add
+    calls until the whole budget is used. Either way the scheduler stays exhausted for the rest of the run
+    and callers are expected to leave the remaining requests for the next run. A calls_per_hour of None
+    means no budget at all.
+
+    With a shared_budget (see _SharedApiCallBudget) every call also has to be covered by the budget all
+    workers draw on, so several workers together still stay within calls_per_hour.
+    """
+
+    write_methods   = { "groups.pools.add" }
+    window_seconds  = 3600
+
+    def __init__( self, calls_per_hour, write_reserve_fraction, shared_budget=None ):
+        self._calls_per_hour    = calls_per_hour
+        self._shared_budget     = shared_budget
+        self._lock              = threading.Lock()
+        self._lookups_exhausted = False
+        self._writes_exhausted  = False
+        self._call_times        = collections.deque()
+        self._calls_made        = {
+            'write'     : 0,
+            'lookup'    : 0,
+        }
+
+        if calls_per_hour is not None:
+            self._call_limits = {
+                'write'     : calls_per_hour,
+                'lookup'    : calls_per_hour * ( 1.0 - write_reserve_fraction ),
+            }
+
+    def acquire( self, method_name ):
+        call_type = "write" if method_name in self.write_methods else "lookup"
+
+        with self._lock:
+            if self._writes_exhausted or ( call_type == "lookup" and self._lookups_exhausted ):
+                raise _ApiBudgetExhausted( f"API call budget already used up, not calling {method_name}" )
+
+            if self._calls_per_hour is not None:
+                current_time = time.monotonic()
+                while self._call_times and self._call_times[0] <= current_time - self.window_seconds:
+                    self._call_times.popleft()
+
+                budget_left = len( self._call_times ) + 1 <= self._call_limits[ call_type ]
+                if budget_left and self._shared_budget is not None:
+                    budget_left = self._shared_budget.take_call( call_type )
+
+                if not budget_left:
+                    self._lookups_exhausted = True
+                    if call_type == "write":
+                        self._writes_exhausted = True
+
+                    raise _ApiBudgetExhausted( f"API call budget of {self._calls_per_hour}/hour used up " +
+                        f"at {method_name}" )
+
+                self._call_times.append( current_time )
+
+            self._calls_made[ call_type ] += 1
+
+    def is_exhausted( self ):
+        # True as soon as lookups are out of budget: no new request could get through its lookups
+        with self._lock:
+            return self._lookups_exhausted
+
+    def get_calls_made( self ):
+        with self._lock:
+            return dict( self._calls_made )
+
+
+class _SharedApiCallBudget:
+    """
+    The API key's calls-per-hour budget kept in Postgres (api_call_reservations), so every worker running
+    with --lease-requests, on any host, draws on one budget instead of each spending a full one.
+
+    Calls are reserved in blocks of reservation_size, so a worker makes one round trip per block rather than
+    per call. A reservation counts against the trailing hour from when it was made, used or not, and
+    release_unused() hands back what's left of the current block at the end of the run. As with the
+    scheduler, lookups can't reserve the last write_reserve_fraction of the budget.
+
+    Not thread safe by itself: _ApiCallScheduler only calls it under its own lock.
+    """
+
+    def __init__( self, db_conn, api_key, calls_per_hour, write_reserve_fraction, reservation_size ):
+        self._db_conn               = db_conn
+        self._api_key               = api_key
+        self._reservation_size      = reservation_size
+        self._reservation_guid      = None
+        self._reserved_calls_left   = 0
+        self._call_limits           = {
+            'write'     : calls_per_hour,
+            'lookup'    : int( calls_per_hour * ( 1.0 - write_reserve_fraction ) ),
+        }
+
+    def take_call( self, call_type ):
+        if self._reserved_calls_left == 0:
+            self._reserve_calls( call_type )
+
+            if self._reserved_calls_left == 0:
+                return False
+
+        self._reserved_calls_left -= 1
+        return True
+
+    def _reserve_calls( self, call_type ):
+        with self._db_conn.cursor() as db_cursor:
+            # Workers reserve one at a time, so two of them can't both take the last of the hour's calls
+            db_cursor.execute( "SELECT pg_advisory_xact_lock( hashtext( %s ) );", (self._api_key,),
+                statement_label="api_budget_lock" )
+
+            db_cursor.execute( """
+                DELETE FROM api_call_reservations
+                WHERE api_key = %s
+                    AND reserved_at <= NOW() - INTERVAL '1 hour';
+            """, (self._api_key,), statement_label="api_budget_prune" )
+
+            db_cursor.execute( """
+                SELECT COALESCE( SUM(call_count), 0 )
+                FROM api_call_reservations
+                WHERE api_key = %s;
+            """, (self._api_key,), statement_label="api_budget_count" )
+            calls_reserved_this_hour = db_cursor.fetchone()[0]
+
+            reserved_calls = max( 0, min( self._reservation_size,
+                self._call_limits[ call_type ] - calls_reserved_this_hour ) )
+
+            if reserved_calls > 0:
+                self._reservation_guid = str( uuid.uuid4() )
+                db_cursor.execute( """
+                    INSERT INTO api_call_reservations( uuid_pk, api_key, reserved_at, call_count )
+                    VALUES ( %s, %s, NOW(), %s );
+                """, (self._reservation_guid, self._api_key, reserved_calls), statement_label="api_budget_reserve" )
+
+        self._db_conn.commit()
+
+        self._reserved_calls_left = reserved_calls
+
+    def release_unused( self ):
+        if self._reservation_guid is None or self._reserved_calls_left == 0:
+            return
+
+        with fga_metrics.labelled_cursor( self._db_conn, "api_budget_release_unused" ) as db_cursor:
+            db_cursor.execute( """
+                UPDATE api_call_reservations
+                SET call_count = call_count - %s
+                WHERE uuid_pk = %s;
+            """, (self._reserved_calls_left, self._reservation_guid) )
+        self._db_conn.commit()
+
+        self._reserved_calls_left = 0
+
+
+class _ScheduledFlickrApi:
+    """
+    Wraps a FlickrAPI handle (or one of its method namespaces, e.g. handle.groups.pools) so that calling
+    any API method first takes a token from the scheduler.
+    """
+
+    def __init__( self, flickrapi_target, api_scheduler, method_name=None ):
+        self._flickrapi_target  = flickrapi_target
+        self._api_scheduler     = api_scheduler
+        self._method_name       = method_name
+
+    def __getattr__( self, attribute_name ):
+        if self._method_name is None:
+            method_name = attribute_name
+        else:
+            method_name = f"{self._method_name}.{attribute_name}"
+
+        return _ScheduledFlickrApi( getattr(self._flickrapi_target, attribute_name), self._api_scheduler,
+            method_name )
+
+    def __call__( self, *args, **kwargs ):
+        self._api_scheduler.acquire( self._method_name )
+
+        with fga_metrics.run_metrics.time_flickr_call( self._method_name ):
+            try:
+                return self._flickrapi_target( *args, **kwargs )
+            except Exception as e:
+                if not _is_expected_flickr_error( self._method_name, e ):
+                    fga_metrics.run_metrics.increment( "fga_flickr_call_errors_total", "method", self._method_name )
+                raise
+
+
+# groups.pools.add answers these as a matter of course (group throttled for the user, added to the pending
+# queue); they're request outcomes, counted in fga_requests_total, not failed calls
+_expected_pool_add_errors = ( "Error: 5:", "Error: 6:" )
+
+
+def _is_expected_flickr_error( method_name, call_error ):
+    return method_name == "groups.pools.add" and isinstance( call_error, flickrapi.exceptions.FlickrError ) and \
+        str( call_error ).startswith( _expected_pool_add_errors )
+
+
+# Per-request chatter; at tens of thousands of requests a night the writes themselves add up, so
+# --quiet turns it off and leaves only per-batch and summary output
+_row_logging_enabled = True
+
+
+def _log_row( message ):
+    if _row_logging_enabled:
+        print( message )
+
+
+def _persist_request_set_state( request_set_state, request_set_state_json_filename  ):
+    with open( request_set_state_json_filename, "w" ) as request_set_state_handle:
+        json.dump( request_set_state, request_set_state_handle, indent=4, sort_keys=True )
+
+
+def _create_state_entry( request_set_state, photo_id, group_id ):
+    state_key = _generate_state_key(photo_id, group_id)
+    request_set_state[state_key] = {
+        'photo_added': False,
+        'fga_add_attempts': [],
+    }
+
+def _read_request_set_with_state( request_set_json_filename, request_set_state_json_filename ):
+
+    with open( request_set_json_filename, "r") as request_set_handle:
+        request_set_info = json.load( request_set_handle )['fga_request_set']
+
+    if os.path.isfile( request_set_state_json_filename  ):
+        with open(request_set_state_json_filename , "r") as request_set_state_handle:
+            request_set_state_info = json.load(request_set_state_handle)
+    else:
+        # First time through, initialize state dictionary
+        request_set_state_info = {}
+
+    return {
+        'request_set'           : request_set_info,
+        'request_set_state'     : request_set_state_info,
+    }
+
+
+def _read_user_flickr_auth_info(args):
+    with open( args.user_auth_info_json, "r") as user_auth_info_handle:
+        user_auth_info = json.load( user_auth_info_handle )
+
+    return user_auth_info
+
+
+def _read_app_flickr_api_key_info(args):
+    with open(args.app_api_key_info_json, "r") as app_api_key_info_handle:
+        app_api_key_info = json.load(app_api_key_info_handle)
+
+    return app_api_key_info
+
+
+def _parse_args():
+    arg_parser = argparse.ArgumentParser(description="Get list of groups for this user")
+    arg_parser.add_argument( "app_api_key_info_json", help="JSON file with app API auth info")
+    arg_parser.add_argument( "user_auth_info_json", help="JSON file with user auth info")
+    arg_parser.add_argument( "postgres_creds_json", help="JSON file with DB credentials" )
+    arg_parser.add_argument( "--dispatch-mode", choices=[ "serial", "per_user" ], default="serial",
+        help="serial: one Flickr handle, one request at a time. per_user: give each user their own Flickr " +
+            "handle for the run and run requests for many users concurrently" )
+    arg_parser.add_argument( "--user-auth-info-dir", default=None,
+        help="Directory of per-user auth JSON files named <flickr_user_cognito_id>.json (required in per_user " +
+            "mode; users without a file are left for the next run)" )
+    arg_parser.add_argument( "--max-concurrent-requests", type=int, default=16,
+        help="Number of requests in flight at the same time across all users (per_user mode)" )
+    arg_parser.add_argument( "--max-concurrent-requests-per-user", type=int, default=2,
+        help="Number of requests in flight at the same time for any one user (per_user mode)" )
+    arg_parser.add_argument( "--journal-batch-size", type=int, default=100,
+        help="Attempt results buffered before they are written to the DB and committed" )
+    arg_parser.add_argument( "--batch-size", type=int, default=500,
+        help="Requests pulled from the DB (or leased) and dispatched at a time" )
+    arg_parser.add_argument( "--lease-requests", action="store_true",
+        help="Lease batches of requests with SKIP LOCKED so several workers (on any host) can run at once" )
+    arg_parser.add_argument( "--lease-seconds", type=int, default=900,
+        help="How long a leased batch is held before other workers may claim it" )
+    arg_parser.add_argument( "--api-calls-per-hour", type=int, default=3600,
+        help="Flickr API call budget for the API key (over a trailing hour); the run stops when it's used up. " +
+            "With --lease-requests it's one budget shared by all workers through the DB, otherwise it's this " +
+            "process's own" )
+    arg_parser.add_argument( "--api-write-reserve-fraction", type=float, default=0.2,
+        help="Fraction of the call budget lookups can't use, kept for groups.pools.add" )
+    arg_parser.add_argument( "--api-budget-reservation-size", type=int, default=50,
+        help="API calls a worker reserves from the shared budget at a time (--lease-requests only)" )
+    arg_parser.add_argument( "--request-order", choices=[ "fair_share", "chronological" ], default="fair_share",
+        help="fair_share: round-robin across users. chronological: strictly oldest request first" )
+    arg_parser.add_argument( "--lease-requests-per-user", type=int, default=10,
+        help="With --lease-requests and fair_share, the most requests one user gets in each leased batch" )
+    arg_parser.add_argument( "--group-throttle-refresh-seconds", type=int, default=60,
+        help="On a group throttle miss, re-read group_throttles (for throttles other workers hit) at most " +
+            "this often" )
+    arg_parser.add_argument( "--flickr-api-rest-url", default=None,
+        help="Send Flickr API calls here instead of the real service (e.g. a local stand-in for testing)" )
+    arg_parser.add_argument( "--quiet", action="store_true",
+        help="Don't log every request, only per-batch progress and the final stats" )
+    fga_lookup_cache.add_lookup_cache_args( arg_parser )
+    fga_metrics.add_metrics_args( arg_parser )
+    args = arg_parser.parse_args()
+
+    # The positional user auth file belongs to one Flickr account; checking anyone else's requests against
+    # it would fail them for good as "not in group"
+    if args.dispatch_mode == "per_user" and args.user_auth_info_dir is None:
+        arg_parser.error( "--dispatch-mode per_user needs --user-auth-info-dir" )
+
+    # Unique per process, so a restarted worker on the same host doesn't think it still holds old leases
+    args.lease_owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4()}"
+
+    return args
+
+
+def _generate_state_key( photo_id, group_id ):
+    return f"photo_{photo_id}_group_{group_id}"
+
+
+def _add_pic_to_group(flickrapi_handle, photo_id, group_id ):
+    # Get current timestamp
+    current_timestamp = datetime.datetime.now( datetime.timezone.utc ).replace( microsecond=0 )
+    #print( f"Timestamp of this attempt: {current_timestamp.isoformat()}" )
+
+    operation_status = {}
+
+    try:
+        _log_row(f"\t* Attempting to add photo {photo_id} to group {group_id}")
+        flickrapi_handle.groups.pools.add( photo_id=photo_id, group_id=group_id )
+
+        # Success!
+        _log_row( "\t\tSuccess!")
+        operation_status[ 'photo_added'] = True
+        operation_status[ 'timestamp' ] =  current_timestamp.isoformat()
+        operation_status[ 'status' ] = 'permstatus_success_added' 
+
+    except flickrapi.exceptions.FlickrError as e:
+        error_string = str(e)
+        group_throttled_msg = "Error: 5:"
+        adding_to_pending_queue_error_msg = "Error: 6:"
+        if error_string.startswith(group_throttled_msg):
+            operation_status = {
+                'timestamp'         : current_timestamp.isoformat(),
+                'status'            : 'defer_group_throttled_for_user',
+                'error_message'     : error_string,
+                'photo_added'       : False
+            }
+            _log_row(f"\t\tGroup {group_id} has hit its throttle limit for the day")
+        elif error_string.startswith(adding_to_pending_queue_error_msg):
+            operation_status = {
+                'timestamp'         : current_timestamp.isoformat(),
+                'status'            : 'permstatus_success_added_queued',
+                'photo_added'       : True
+            }
+            _log_row( "\t\tSuccess (added to pending queue)!")
+        else:
+            _log_row( f"\t\t{error_string}" )
+            operation_status = {
+                'timestamp'         : current_timestamp.isoformat(),
+                'status'            : 'fail_' + str(e),
+                'photo_added'       : False,
+            }
+
+    return operation_status
+
+
+def _has_add_attempt_within_same_utc_day(state_entry):
+    has_add_attempt_within_same_utc_day = False
+    #seconds_in_one_day = 86400
+    current_timestamp = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    for curr_add_attempt in state_entry['fga_add_attempts']:
+        add_attempt_timestamp = datetime.datetime.fromisoformat(curr_add_attempt['timestamp'])
+        if current_timestamp.date() == add_attempt_timestamp.date():
+            has_add_attempt_within_same_utc_day = True
+            break
+
+    #print(f"\t\tDate {add_attempt_timestamp.date()} == {current_timestamp.date()}? {has_add_attempt_within_same_utc_day}")
+
+    return has_add_attempt_within_same_utc_day
+
+
+def _is_request_set_json( json_filename ):
+    with open( json_filename, "r" ) as json_handle:
+        parsed_json = json.load( json_handle )
+
+    return 'fga_request_set' in parsed_json
+
+
+
+def _get_group_memberships_for_user( flickrapi_handle, lookup_cache, user_nsid, require_fresh=False ):
+    return_groups = {}
+    user_groups = fga_lookup_cache.get_user_groups( flickrapi_handle, lookup_cache, user_nsid, require_fresh )
+
+    for curr_group in user_groups:
+        #print("Processing group:\n" + json.dumps(curr_group, indent=4, sort_keys=True) )
+        if 'id' in curr_group:
+            return_groups[curr_group['id']] = None
+             
+
+    return return_groups
+
+
+def _record_pic_added_to_group( lookup_cache, groups_per_pic, pic_id, group_id ):
+    # Write through to both the per-run and persistent caches so the next lookup already knows
+    group_entry = { 'id': group_id }
+    if pic_id in groups_per_pic:
+        groups_per_pic[ pic_id ][ group_id ] = group_entry
+
+    def _add_group_entry( group_memberships ):
+        group_memberships[ group_id ] = group_entry
+        return group_memberships
+
+    lookup_cache.update_if_cached( "pic_groups", pic_id, _add_group_entry )
+
+
+class _AttemptJournal:
+    """
+    Buffers group_add_attempts writes so each request doesn't cost its own INSERT and UPDATE.
+
+    Attempt starts are written and committed in bulk *before* any Flickr calls are made for them, so
+    after a crash those requests already have an attempt dated today and won't be retried until
+    tomorrow. Completions are buffered and written with one UPDATE per flush_batch_size results, each
+    flush in its own transaction, so a crash loses at most one batch of final statuses.
+
+    One journal per DB connection; it's safe to share between threads using that connection.
+
+    When requests are leased (lease_owner is set), claiming also renews the lease in the same
+    transaction, and only returns the requests this worker still holds and nobody has attempted today.
+    Anything another worker took over after our lease ran out is left to them.
+    """
+
+    def __init__( self, db_conn, flush_batch_size, lease_owner=None, lease_seconds=None ):
+        self.flush_batch_size       = flush_batch_size
+        self._db_conn               = db_conn
+        self._lease_owner           = lease_owner
+        self._lease_seconds         = lease_seconds
+        self._completed_attempts    = []
+        self._released_attempts     = []
+        self._lock                  = threading.Lock()
+
+    def claim_requests( self, user_requests ):
+        request_ids = [ user_request_details['request_id'] for user_request_details in user_requests ]
+
+        if not request_ids:
+            return {}
+
+        with self._lock:
+            with fga_metrics.labelled_cursor( self._db_conn, "attempt_claim" ) as db_cursor:
+                if self._lease_owner is not None:
+                    request_ids = self._renew_leases_locked( db_cursor, request_ids )
+
+                add_attempt_guids = {}
+                for request_id in request_ids:
+                    add_attempt_guids[ request_id ] = str( uuid.uuid4() )
+
+                if add_attempt_guids:
+                    sql_command = """
+                        INSERT INTO group_add_attempts( uuid_pk, submitted_request_fk, attempt_started )
+                        VALUES %s;
+                    """
+
+                    psycopg2.extras.execute_values( db_cursor, sql_command,
+                        [ (add_attempt_guids[request_id], request_id) for request_id in add_attempt_guids ],
+                        template="( %s, %s, NOW() )", page_size=self.flush_batch_size )
+
+            self._db_conn.commit()
+
+        return add_attempt_guids
+
+    def _renew_leases_locked( self, db_cursor, request_ids ):
+        sql_command = """
+            UPDATE submitted_requests
+            SET lease_expires = NOW() + %s * INTERVAL '1 second'
+            WHERE uuid_pk = ANY( %s::uuid[] )
+                AND lease_owner = %s
+                AND ( last_attempt_started IS NULL OR DATE(last_attempt_started) <> DATE(NOW()) )
+            RETURNING uuid_pk;
+        """
+
+        db_cursor.execute( sql_command, (self._lease_seconds, [ str(request_id) for request_id in request_ids ],
+            self._lease_owner), statement_label="lease_renewal" )
+        still_leased_ids = { str(returned_row[0]) for returned_row in db_cursor.fetchall() }
+
+        return [ request_id for request_id in request_ids if str(request_id) in still_leased_ids ]
+
+    def record_completion( self, add_attempt_guid, final_status ):
+        attempt_completed = datetime.datetime.now( datetime.timezone.utc )
+
+        with self._lock:
+            self._completed_attempts.append( (add_attempt_guid, attempt_completed, final_status) )
+            if len( self._completed_attempts ) >= self.flush_batch_size:
+                self._flush_locked()
+
+    def release_claims( self, add_attempt_guids ):
+        # Claimed but never attempted (e.g. the API budget ran out); deleting the attempt makes the
+        # request actionable again. If we crash before this is flushed the request just sits out today
+        with self._lock:
+            self._released_attempts.extend( add_attempt_guids )
+
+    def flush( self ):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked( self ):
+        if self._released_attempts:
+            with fga_metrics.labelled_cursor( self._db_conn, "attempt_release" ) as db_cursor:
+                db_cursor.execute( "DELETE FROM group_add_attempts WHERE uuid_pk = ANY( %s::uuid[] );",
+                    (self._released_attempts,) )
+            self._db_conn.commit()
+
+            self._released_attempts = []
+
+        if not self._completed_attempts:
+            return
+
+        sql_command = """
+            UPDATE group_add_attempts
+            SET attempt_completed = completed_attempts.attempt_completed,
+                final_status = completed_attempts.final_status
+            FROM ( VALUES %s ) AS completed_attempts( uuid_pk, attempt_completed, final_status )
+            WHERE group_add_attempts.uuid_pk = completed_attempts.uuid_pk;
+        """
+
+        with fga_metrics.labelled_cursor( self._db_conn, "attempt_completion" ) as db_cursor:
+            psycopg2.extras.execute_values( db_cursor, sql_command, self._completed_attempts,
+                template="( %s::uuid, %s::timestamptz, %s )", page_size=self.flush_batch_size )
+        self._db_conn.commit()
+
+        self._completed_attempts = []
+
+    def record_group_throttle( self, user_cognito_id, group_id, throttle_date ):
+        # Written straight away rather than batched, so a re-run later today sees it even after a crash
+        sql_command = """
+            INSERT INTO group_throttles( flickr_user_cognito_id, flickr_group_id, throttle_date, throttle_recorded )
+            VALUES ( %s, %s, %s, NOW() )
+            ON CONFLICT DO NOTHING;
+        """
+
+        with self._lock:
+            with fga_metrics.labelled_cursor( self._db_conn, "group_throttle_record" ) as db_cursor:
+                db_cursor.execute( sql_command, (user_cognito_id, group_id, throttle_date) )
+            self._db_conn.commit()
+
+
+class _GroupThrottleRegistry:
+    """
+    Groups that have told a user "Error: 5" (throttle limit hit) today, keyed by (user, group, UTC date).
+
+    Loaded from group_throttles at the start of the run and shared by all workers, so every later request
+    for the same user and group is deferred without another doomed groups.pools.add call. Other processes
+    (e.g. leasing workers on other hosts) record theirs in the same table, so on a miss the table is read
+    again, at most once every refresh_seconds, before the caller goes to Flickr.
+
+    Only today's rows are ever read; load() deletes older ones.
+    """
+
+    def __init__( self, refresh_seconds=None ):
+        self._refresh_seconds   = refresh_seconds
+        self._db_conn           = None
+        self._last_loaded       = None
+        self._throttled_groups  = set()
+        self._lock              = threading.Lock()
+
+    def load( self, db_conn ):
+        with fga_metrics.labelled_cursor( db_conn, "group_throttle_prune" ) as db_cursor:
+            db_cursor.execute( "DELETE FROM group_throttles WHERE throttle_date < %s;", (_current_utc_date(),) )
+            pruned_throttle_count = db_cursor.rowcount
+        db_conn.commit()
+
+        with self._lock:
+            self._db_conn = db_conn
+            self._load_locked()
+            loaded_throttle_count = len( self._throttled_groups )
+
+        print( f"Loaded {loaded_throttle_count} group throttles already hit today " +
+            f"(pruned {pruned_throttle_count} from earlier days)" )
+
+    def _load_locked( self ):
+        sql_command = """
+            SELECT flickr_user_cognito_id, flickr_group_id, throttle_date
+            FROM group_throttles
+            WHERE throttle_date = %s;
+        """
+
+        current_utc_date = _current_utc_date()
+        with fga_metrics.labelled_cursor( self._db_conn, "group_throttle_load" ) as db_cursor:
+            db_cursor.execute( sql_command, (current_utc_date,) )
+            loaded_throttles = db_cursor.fetchall()
+        self._db_conn.commit()
+
+        # Our own throttles may not be committed yet, so add to what we know rather than replacing it
+        self._throttled_groups = { throttle_key for throttle_key in self._throttled_groups
+            if throttle_key[2] == current_utc_date }
+        for ( user_cognito_id, group_id, throttle_date ) in loaded_throttles:
+            self._throttled_groups.add( (str(user_cognito_id), group_id, throttle_date) )
+
+        self._last_loaded = time.monotonic()
+
+    def is_group_throttled( self, user_cognito_id, group_id ):
+        throttle_key = ( str(user_cognito_id), group_id, _current_utc_date() )
+
+        with self._lock:
+            if throttle_key in self._throttled_groups:
+                return True
+
+            if self._db_conn is not None and self._refresh_seconds is not None and \
+                    time.monotonic() - self._last_loaded >= self._refresh_seconds:
+                self._load_locked()
+
+            return throttle_key in self._throttled_groups
+
+    def mark_group_throttled( self, attempt_journal, user_cognito_id, group_id ):
+        throttle_date = _current_utc_date()
+
+        with self._lock:
+            self._throttled_groups.add( (str(user_cognito_id), group_id, throttle_date) )
+
+        attempt_journal.record_group_throttle( user_cognito_id, group_id, throttle_date )
+
+
+def _current_utc_date():
+    return datetime.datetime.now( datetime.timezone.utc ).date()
+
+
+def _create_attempt_journal( args, db_conn ):
+    if args.lease_requests:
+        return _AttemptJournal( db_conn, args.journal_batch_size, args.lease_owner, args.lease_seconds )
+
+    return _AttemptJournal( db_conn, args.journal_batch_size )
+
+
+def _connect_to_db( pgsql_creds ):
+    return psycopg2.connect(
+        host        = pgsql_creds['db_host'],
+        user        = pgsql_creds['db_user'],
+        password    = pgsql_creds['db_passwd'],
+        database    = pgsql_creds['db_dbname'],
+        cursor_factory  = fga_metrics.InstrumentedCursor )
+
+
+def _new_stats():
+    return {
+        'skipped_already_added'     : 0,
+        'skipped_too_soon'          : 0,
+        'attempted_success'         : 0,
+        'attempted_fail'            : 0,
+        'deferred'                  : 0,
+        'throttle_api_calls_avoided': 0,
+        'skipped_lease_lost'        : 0,
+        'left_for_next_run'         : 0,
+        'users_failed'              : 0,
+    }
+
+
+def _merge_stats( total_stats, worker_stats ):
+    for stat_name in worker_stats:
+        total_stats[ stat_name ] = total_stats.get( stat_name, 0 ) + worker_stats[ stat_name ]
+
+
+def _record_attempt_status_in_stats( attempt_status, stats ):
+    fga_metrics.run_metrics.end_request( attempt_status )
+
+    if attempt_status == "permstatus_success_pic_already_in_group":
+        stats['skipped_already_added'] += 1
+    elif attempt_status.startswith( "permstatus_success" ):
+        stats['attempted_success'] += 1
+    elif attempt_status.startswith( "defer_" ):
+        stats['deferred'] += 1
+    else:
+        stats['attempted_fail'] += 1
+
+
+def _look_up_groups_for_request( flickrapi_handle, user_nsid, lookup_cache, user_request_details, user_groups,
+        groups_per_pic ):
+
+    # If this is the first time we've hit this user, pull their list of group memberships to see if if's even a
+    # possibility to add it
+    if user_request_details["request_user_cognito_id"] not in user_groups:
+        user_groups[ user_request_details["request_user_cognito_id"] ] = _get_group_memberships_for_user(
+            flickrapi_handle, lookup_cache, user_nsid )
+        #print( "User memberships:\n" + 
+        #    json.dumps( user_groups[ user_request_details["request_user_cognito_id"] ], indent=4, sort_keys=True) )
+
+
+    # If this is first time we've seen this picture, pull list of groups it's already in
+    if user_request_details["request_flickr_picture_id"] not in groups_per_pic:
+        groups_per_pic[ user_request_details["request_flickr_picture_id"] ] = \
+            fga_lookup_cache.get_group_memberships_for_pic( flickrapi_handle, lookup_cache,
+                user_request_details["request_flickr_picture_id"] )
+
+        #print( "initialized cache of groups for pic " + user_request_details["request_flickr_picture_id"] + " to:" +
+        #    json.dumps( groups_per_pic[ user_request_details["request_flickr_picture_id"] ], indent=4,
+        #    sort_keys=True) )
+
+    # Both permanent outcomes below can come from a lookup an earlier run cached (e.g. from before the user
+    # joined the group), so confirm them against Flickr before they're recorded
+    if user_request_details['request_flickr_group_id'] not in \
+            user_groups[ user_request_details["request_user_cognito_id"] ]:
+
+        user_groups[ user_request_details["request_user_cognito_id"] ] = _get_group_memberships_for_user(
+            flickrapi_handle, lookup_cache, user_nsid, require_fresh=True )
+
+    elif user_request_details['request_flickr_group_id'] in \
+            groups_per_pic[user_request_details["request_flickr_picture_id"]]:
+
+        groups_per_pic[ user_request_details["request_flickr_picture_id"] ] = \
+            fga_lookup_cache.get_group_memberships_for_pic( flickrapi_handle, lookup_cache,
+                user_request_details["request_flickr_picture_id"], require_fresh=True )
+
+
+def _process_user_request( flickrapi_handle, user_nsid, lookup_cache, attempt_journal, throttle_registry,
+        add_attempt_guid, user_request_details, user_groups, groups_per_pic, stats ):
+    _log_row( "Got user request:\n" + json.dumps(user_request_details, indent=4, sort_keys=True, default=str) )
+
+    # If this group already throttled this user today, any add attempt is doomed; defer without touching Flickr
+    if throttle_registry.is_group_throttled( user_request_details["request_user_cognito_id"],
+            user_request_details['request_flickr_group_id'] ):
+
+        _log_row( f"Group {user_request_details['request_flickr_group_id']} already hit its throttle limit for " +
+            "this user today, deferring without an API call" )
+        attempt_journal.record_completion( add_attempt_guid, "defer_group_throttled_for_user" )
+        _record_attempt_status_in_stats( "defer_group_throttled_for_user", stats )
+        stats['throttle_api_calls_avoided'] += 1
+        return
+
+
+    try:
+        _look_up_groups_for_request( flickrapi_handle, user_nsid, lookup_cache, user_request_details, user_groups,
+            groups_per_pic )
+
+    except flickrapi.exceptions.FlickrError as e:
+        # e.g. the picture was deleted or made private, or Flickr was briefly unavailable. Recorded the same as
+        # a failed add: not permanent, so the request comes round again on a later day
+        _log_row( f"\t\tGroup lookup failed: {e}" )
+        attempt_journal.record_completion( add_attempt_guid, 'fail_' + str(e) )
+        _record_attempt_status_in_stats( 'fail_' + str(e), stats )
+        return
+
+    # If the user isn't in the requested group, mark a permfail
+    if user_request_details['request_flickr_group_id'] not in \
+            user_groups[ user_request_details["request_user_cognito_id"] ]:
+
+        _log_row( "User requested a picture be added into a group they are not in" )
+        attempt_status = "permstatus_fail_user_not_in_flickr_group"
+
+    # If this pic is already in the requested group, skip it
+    elif user_request_details['request_flickr_group_id'] in \
+        groups_per_pic[user_request_details["request_flickr_picture_id"]]:
+
+        _log_row( f"Pic {user_request_details['request_flickr_picture_id']} already in group " +
+            f"{user_request_details['request_flickr_group_id']}" )
+
+        attempt_status = "permstatus_success_pic_already_in_group"
+
+    else:
+        # Let's see if the most recent attempt status tells us not try to again (e.g., pic already in group)
+        _log_row( "User is in requested group and the picture is not in the group, attempting group add API call" )
+
+        results_of_add_attempt = _add_pic_to_group( flickrapi_handle, 
+            user_request_details["request_flickr_picture_id"],
+            user_request_details['request_flickr_group_id'] )
+
+        attempt_status = results_of_add_attempt['status']
+
+        if attempt_status == "permstatus_success_added":
+            _record_pic_added_to_group( lookup_cache, groups_per_pic, user_request_details["request_flickr_picture_id"],
+                user_request_details['request_flickr_group_id'] )
+
+        elif attempt_status == "defer_group_throttled_for_user":
+            throttle_registry.mark_group_throttled( attempt_journal, user_request_details["request_user_cognito_id"],
+                user_request_details['request_flickr_group_id'] )
+
+            #print( "Results of add attempt:\n" + json.dumps(results_of_add_attempt) )
+
+    # Journal the outcome of this attempt; written out with the rest of its batch
+    attempt_journal.record_completion( add_attempt_guid, attempt_status )
+
+    _record_attempt_status_in_stats( attempt_status, stats )
+
+
+def _process_claimed_requests( flickrapi_handle, user_nsid, lookup_cache, attempt_journal, throttle_registry,
+        api_scheduler, add_attempt_guids, request_batch, user_groups, groups_per_pic, stats ):
+    # Returns False if the API budget ran out part way through; the claims not yet attempted are handed back
+    for ( request_index, user_request_details ) in enumerate( request_batch ):
+        if user_request_details['request_id'] not in add_attempt_guids:
+            _log_row( f"Lease on request {user_request_details['request_id']} was taken over by another worker" )
+            stats['skipped_lease_lost'] += 1
+            continue
+
+        fga_metrics.run_metrics.begin_request()
+        try:
+            # Requests already under way (e.g. on other threads) may still use the write reserve; new ones don't start
+            if api_scheduler.is_exhausted():
+                raise _ApiBudgetExhausted( "API call budget for lookups used up" )
+
+            _process_user_request( flickrapi_handle, user_nsid, lookup_cache, attempt_journal, throttle_registry,
+                add_attempt_guids[ user_request_details['request_id'] ], user_request_details, user_groups,
+                groups_per_pic, stats )
+
+        except _ApiBudgetExhausted as e:
+            # Hand back this request and everything after it that we claimed, then stop cleanly
+            print( f"{e}; leaving the remaining requests for the next run" )
+            attempt_journal.release_claims( [ add_attempt_guids[curr_request['request_id']]
+                for curr_request in request_batch[request_index:]
+                if curr_request['request_id'] in add_attempt_guids ] )
+            stats['left_for_next_run'] += len( request_batch ) - request_index
+            return False
+
+    return True
+
+
+def _process_user_requests( flickrapi_handle, user_nsid, lookup_cache, attempt_journal, throttle_registry,
+        api_scheduler, user_requests, user_groups, groups_per_pic, stats ):
+    for batch_start in range( 0, len(user_requests), attempt_journal.flush_batch_size ):
+        if api_scheduler.is_exhausted():
+            stats['left_for_next_run'] += len( user_requests ) - batch_start
+            return
+
+        request_batch = user_requests[ batch_start : batch_start + attempt_journal.flush_batch_size ]
+
+        # Attempt starts are committed before any API calls so a crash can't lead to a second attempt today
+        add_attempt_guids = attempt_journal.claim_requests( request_batch )
+
+        if not _process_claimed_requests( flickrapi_handle, user_nsid, lookup_cache, attempt_journal,
+                throttle_registry, api_scheduler, add_attempt_guids, request_batch, user_groups, groups_per_pic,
+                stats ):
+
+            stats['left_for_next_run'] += len( user_requests ) - batch_start - len( request_batch )
+            return
+
+
+def _interleave_requests_by_user( user_requests ):
+    # Round-robin across users (each user's requests stay in chronological order), so a user with a huge
+    # backlog can't use up the API budget before everyone else has had a turn
+    interleaved_requests = []
+    user_queues = list( _group_user_requests_by_user(user_requests).values() )
+    for request_rank in range( max( [ len(curr_queue) for curr_queue in user_queues ], default=0 ) ):
+        for curr_queue in user_queues:
+            if request_rank < len( curr_queue ):
+                interleaved_requests.append( curr_queue[request_rank] )
+
+    return interleaved_requests
+
+
+def _read_user_flickr_auth_info_for_cognito_id( args, user_cognito_id ):
+    # Per-user auth files are named after the cognito ID of the user they belong to. Returns None if this
+    # user has no file
+    user_auth_info_json = os.path.join( args.user_auth_info_dir, f"{user_cognito_id}.json" )
+    if not os.path.isfile( user_auth_info_json ):
+        return None
+
+    with open( user_auth_info_json, "r" ) as user_auth_info_handle:
+        return json.load( user_auth_info_handle )
+
+
+def _group_user_requests_by_user( user_requests ):
+    # Preserves chronological order of requests within each user
+    requests_per_user = {}
+    for user_request_details in user_requests:
+        requests_per_user.setdefault( user_request_details['request_user_cognito_id'], [] ).append(
+            user_request_details )
+
+    return requests_per_user
+
+
+def _group_user_requests_by_pic( user_requests ):
+    # All requests for one picture stay on the same worker so the groups-per-pic lookup is only done once
+    requests_per_pic = {}
+    for user_request_details in user_requests:
+        requests_per_pic.setdefault( user_request_details['request_flickr_picture_id'], [] ).append(
+            user_request_details )
+
+    return list( requests_per_pic.values() )
+
+
+def _batch_user_requests_by_pic( user_requests, batch_size ):
+    # Journal-sized batches that never split one picture's requests across two batches
+    request_batch = []
+    for pic_requests in _group_user_requests_by_pic( user_requests ):
+        request_batch.extend( pic_requests )
+        if len( request_batch ) >= batch_size:
+            yield request_batch
+            request_batch = []
+
+    if request_batch:
+        yield request_batch
+
+
+class _UserWorker:
+    # What per_user mode keeps for one user for the whole run: their Flickr handle, their lookups, and the
+    # picture chunks of theirs waiting to run. Guarded by the dispatcher's lock except where noted
+    def __init__( self, user_cognito_id, flickrapi_handle, user_nsid ):
+        self.user_cognito_id    = user_cognito_id
+        self.flickrapi_handle   = flickrapi_handle
+        self.user_nsid          = user_nsid
+        self.user_groups        = {}
+        self.groups_per_pic     = {}
+        self.groups_lock        = threading.Lock()      # guards fetching user_groups, not the dispatcher state
+        self.queued_chunks      = collections.deque()
+        self.chunks_running     = 0
+        self.failed             = False
+
+
+class _PerUserDispatcher:
+    """
+    Runs per_user mode for the whole run, fed one batch at a time from the request stream (or leases).
+
+    Each user gets one _UserWorker the first time they turn up, kept for every later batch, so their
+    Flickr handle and group lookups are only set up once. Requests are claimed through one shared journal
+    in journal-sized batches across all users, however few requests each user has in a batch, then queued
+    per user as picture chunks. At most max_concurrent_requests chunks run at once across all users, and at
+    most max_concurrent_requests_per_user for any one user; the next chunk for a user starts as soon as one of
+    theirs finishes, so nobody waits on the slowest user in a batch.
+
+    dispatch() returns once fewer than a batch of requests are still waiting, so the next batch is pulled
+    while this one finishes without claims piling up ahead of the workers.
+    """
+
+    def __init__( self, args, app_flickr_api_key_info, lookup_cache, throttle_registry, api_scheduler,
+            attempt_journal ):
+        self._args                      = args
+        self._app_flickr_api_key_info   = app_flickr_api_key_info
+        self._lookup_cache              = lookup_cache
+        self._throttle_registry         = throttle_registry
+        self._api_scheduler             = api_scheduler
+        self._attempt_journal           = attempt_journal
+        self._executor                  = concurrent.futures.ThreadPoolExecutor(
+                                            max_workers=args.max_concurrent_requests )
+        self._user_workers              = {}
+        self._requests_outstanding      = 0
+        self._stats                     = _new_stats()
+        self._lock                      = threading.Condition()
+
+    def dispatch( self, user_submitted_requests ):
+        runnable_requests = []
+        for user_request_details in user_submitted_requests:
+            user_worker = self._get_user_worker( user_request_details['request_user_cognito_id'] )
+            if user_worker is None or user_worker.failed:
+                # Nothing has been claimed for these, so they're simply still pending for the next run
+                with self._lock:
+                    self._stats['left_for_next_run'] += 1
+                continue
+
+            runnable_requests.append( user_request_details )
+
+        requests_dispatched = 0
+        for request_batch in _batch_user_requests_by_pic( runnable_requests, self._attempt_journal.flush_batch_size ):
+            if self._api_scheduler.is_exhausted():
+                with self._lock:
+                    self._stats['left_for_next_run'] += len( runnable_requests ) - requests_dispatched
+                break
+
+            # One claim (and commit) per journal batch, whichever users the batch's requests belong to
+            add_attempt_guids = self._attempt_journal.claim_requests( request_batch )
+
+            for pic_requests in _group_user_requests_by_pic( request_batch ):
+                self._queue_chunk( self._user_workers[ pic_requests[0]['request_user_cognito_id'] ],
+                    add_attempt_guids, pic_requests )
+
+            requests_dispatched += len( request_batch )
+
+        with self._lock:
+            while self._requests_outstanding >= self._args.batch_size:
+                self._lock.wait()
+
+    def finish( self ):
+        # Waits for everything already queued; returns the stats for the whole run
+        with self._lock:
+            while self._requests_outstanding > 0:
+                self._lock.wait()
+
+        self._executor.shutdown()
+
+        with self._lock:
+            return dict( self._stats )
+
+    def _get_user_worker( self, user_cognito_id ):
+        # Only called from the dispatching thread, so creating workers needs no lock
+        if user_cognito_id not in self._user_workers:
+            user_flickr_auth_info = _read_user_flickr_auth_info_for_cognito_id( self._args, user_cognito_id )
+            if user_flickr_auth_info is None:
+                print( f"No auth info for user {user_cognito_id} in {self._args.user_auth_info_dir}, leaving " +
+                    "their requests for the next run" )
+                with self._lock:
+                    self._stats['users_failed'] += 1
+                self._user_workers[ user_cognito_id ] = None
+            else:
+                self._user_workers[ user_cognito_id ] = _UserWorker( user_cognito_id,
+                    _create_flickr_api_handle( self._args, self._app_flickr_api_key_info, user_flickr_auth_info,
+                        self._api_scheduler ),
+                    user_flickr_auth_info['user_nsid'] )
+
+        return self._user_workers[ user_cognito_id ]
+
+    def _queue_chunk( self, user_worker, add_attempt_guids, pic_requests ):
+        with self._lock:
+            user_worker.queued_chunks.append( (add_attempt_guids, pic_requests) )
+            self._requests_outstanding += len( pic_requests )
+            self._start_chunks_locked( user_worker )
+
+    def _start_chunks_locked( self, user_worker ):
+        while user_worker.queued_chunks and \
+                user_worker.chunks_running < self._args.max_concurrent_requests_per_user:
+            ( add_attempt_guids, pic_requests ) = user_worker.queued_chunks.popleft()
+            user_worker.chunks_running += 1
+            self._executor.submit( self._run_chunk, user_worker, add_attempt_guids, pic_requests )
+
+    def _run_chunk( self, user_worker, add_attempt_guids, pic_requests ):
+        chunk_stats = _new_stats()
+
+        try:
+            if user_worker.failed:
+                # Their claims stay as started, so these sit out today like the ones that were running
+                chunk_stats['left_for_next_run'] += len( pic_requests )
+            else:
+                self._run_user_chunk( user_worker, add_attempt_guids, pic_requests, chunk_stats )
+
+        finally:
+            with self._lock:
+                _merge_stats( self._stats, chunk_stats )
+                user_worker.chunks_running -= 1
+                self._requests_outstanding -= len( pic_requests )
+                self._start_chunks_locked( user_worker )
+                self._lock.notify_all()
+
+    def _run_user_chunk( self, user_worker, add_attempt_guids, pic_requests, chunk_stats ):
+        try:
+            # Pulled once per user before any of their requests, so their concurrent chunks don't race to fetch it
+            with user_worker.groups_lock:
+                if user_worker.user_cognito_id not in user_worker.user_groups:
+                    user_worker.user_groups[ user_worker.user_cognito_id ] = _get_group_memberships_for_user(
+                        user_worker.flickrapi_handle, self._lookup_cache, user_worker.user_nsid )
+
+            _process_claimed_requests( user_worker.flickrapi_handle, user_worker.user_nsid, self._lookup_cache,
+                self._attempt_journal, self._throttle_registry, self._api_scheduler, add_attempt_guids,
+                pic_requests, user_worker.user_groups, user_worker.groups_per_pic, chunk_stats )
+
+        except _ApiBudgetExhausted as e:
+            print( f"{e}; leaving requests for user {user_worker.user_cognito_id} for the next run" )
+            self._attempt_journal.release_claims( [ add_attempt_guids[curr_request['request_id']]
+                for curr_request in pic_requests if curr_request['request_id'] in add_attempt_guids ] )
+            chunk_stats['left_for_next_run'] += len( pic_requests )
+
+        except Exception as e:
+            # One user's failure (bad token, network blip) must not take down everyone else's run. The rest of
+            # their requests are dropped rather than each spending an API call to fail the same way
+            with self._lock:
+                if not user_worker.failed:
+                    user_worker.failed = True
+                    print( f"Requests for user {user_worker.user_cognito_id} failed: {e}" )
+                    chunk_stats['users_failed'] += 1
+
+
+def _stream_request_batches( args, db_conn ):
+    # Explaination of query
+    #
+    #   The latest attempt start and final status of every request are kept on submitted_requests
+    #   by a trigger on group_add_attempts, so this never has to scan the attempt history. A request
+    #   is actionable if it has never reached a permstatus_* status and hasn't been attempted today.
+    #   submitted_requests_actionable_idx only covers the non-permanent rows, so the cost of this
+    #   tracks the amount of outstanding work, not how many attempts have piled up over time
+    #
+    #   Rows come through a server-side cursor a batch at a time so memory doesn't grow with the backlog.
+    #   It's declared WITH HOLD and committed straight away: Postgres materialises the result on the server
+    #   and the cursor stays readable without leaving a transaction open (and vacuum held back) all run
+    #
+    #   fair_share ordering takes every user's oldest request first, then every user's second oldest,
+    #   and so on, so the API budget is spread across users instead of going to whoever has the
+    #   biggest backlog. That needs a sort over all actionable rows rather than an index walk
+
+    if args.request_order == "fair_share":
+        sql_command = """
+            SELECT      uuid_pk,
+                        flickr_user_cognito_id,
+                        picture_flickr_id,
+                        flickr_group_id
+            FROM (
+                SELECT  uuid_pk,
+                        flickr_user_cognito_id,
+                        picture_flickr_id,
+                        flickr_group_id,
+                        request_datetime,
+                        ROW_NUMBER() OVER ( 
+                            PARTITION BY flickr_user_cognito_id ORDER BY request_datetime ) AS user_request_rank
+                FROM submitted_requests
+                WHERE has_permanent_status = FALSE
+                    AND ( last_attempt_started IS NULL OR DATE(last_attempt_started) <> DATE(NOW()) )
+            ) AS actionable_requests
+            ORDER BY user_request_rank, request_datetime;
+        """
+    else:
+        sql_command = """
+            SELECT      uuid_pk,
+                        flickr_user_cognito_id,
+                        picture_flickr_id,
+                        flickr_group_id
+            FROM submitted_requests
+            WHERE has_permanent_status = FALSE
+                AND ( last_attempt_started IS NULL OR DATE(last_attempt_started) <> DATE(NOW()) )
+            ORDER BY request_datetime;
+        """
+
+    with fga_metrics.labelled_cursor( db_conn, f"request_stream_{args.request_order}", name="fga_actionable_requests",
+            withhold=True ) as db_cursor:
+        db_cursor.itersize = args.batch_size
+        db_cursor.execute( sql_command )
+        db_conn.commit()
+
+        while True:
+            # psycopg2 opens a transaction for the FETCH too; don't leave it open while the batch runs
+            returned_rows = db_cursor.fetchmany( args.batch_size )
+            db_conn.commit()
+
+            if not returned_rows:
+                break
+
+            yield [ _user_request_details_from_row(curr_row) for curr_row in returned_rows ]
+
+
+# Times in a row a fair_share claim can find candidates but lose every one of them to other workers before
+# giving up; each retry picks new candidates, as the ones already leased drop out
+_fair_share_claim_retries = 3
+
+
+def _claim_request_batches( args, db_conn ):
+    # Any number of workers, on any number of hosts, can run this at once. SKIP LOCKED means two workers
+    # never wait on or claim the same rows, and the lease means rows held by a worker that died become
+    # claimable again once it expires. The claim is committed straight away so the row locks are only
+    # held for the length of this statement; from then on the lease is what keeps other workers off.
+    #
+    # The lease and attempted-today checks sit in the locking SELECT itself, so Postgres re-checks them
+    # against the latest version of any row another worker claimed or attempted after this statement
+    # started.
+    #
+    # chronological claims are an index walk over the oldest actionable rows. fair_share claims take
+    # each user's oldest lease_requests_per_user actionable rows (see _select_fair_share_candidates), then
+    # the oldest batch_size of those, so a user with a huge backlog at the head of the queue only ever gets
+    # their share of each batch
+    chronological_sql_command = """
+        UPDATE submitted_requests
+        SET lease_owner = %s,
+            lease_expires = NOW() + %s * INTERVAL '1 second'
+        WHERE uuid_pk IN (
+            SELECT uuid_pk
+            FROM submitted_requests
+            WHERE has_permanent_status = FALSE
+                AND ( last_attempt_started IS NULL OR DATE(last_attempt_started) <> DATE(NOW()) )
+                AND ( lease_expires IS NULL OR lease_expires < NOW() )
+            ORDER BY request_datetime
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING   uuid_pk,
+                    flickr_user_cognito_id,
+                    picture_flickr_id,
+                    flickr_group_id,
+                    request_datetime;
+    """
+
+    fair_share_sql_command = """
+        UPDATE submitted_requests
+        SET lease_owner = %s,
+            lease_expires = NOW() + %s * INTERVAL '1 second'
+        WHERE uuid_pk IN (
+            SELECT uuid_pk
+            FROM submitted_requests
+            WHERE uuid_pk = ANY( %s::uuid[] )
+                AND has_permanent_status = FALSE
+                AND ( last_attempt_started IS NULL OR DATE(last_attempt_started) <> DATE(NOW()) )
+                AND ( lease_expires IS NULL OR lease_expires < NOW() )
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING   uuid_pk,
+                    flickr_user_cognito_id,
+                    picture_flickr_id,
+                    flickr_group_id,
+                    request_datetime;
+    """
+
+    lost_claims = 0
+    while True:
+        with fga_metrics.labelled_cursor( db_conn, f"lease_claim_{args.request_order}" ) as db_cursor:
+            if args.request_order == "fair_share":
+                candidate_ids = _select_fair_share_candidates( args, db_cursor )
+                if not candidate_ids:
+                    returned_rows = []
+                else:
+                    db_cursor.execute( fair_share_sql_command, (args.lease_owner, args.lease_seconds,
+                        candidate_ids) )
+                    returned_rows = db_cursor.fetchall()
+            else:
+                candidate_ids = None
+                db_cursor.execute( chronological_sql_command, (args.lease_owner, args.lease_seconds,
+                    args.batch_size) )
+                returned_rows = db_cursor.fetchall()
+        db_conn.commit()
+
+        if not returned_rows:
+            # Another worker leased this round's candidates between our two statements; pick again
+            if candidate_ids and lost_claims < _fair_share_claim_retries:
+                lost_claims += 1
+                continue
+
+            break
+
+        lost_claims = 0
+        print( f"Worker {args.lease_owner} leased {len(returned_rows)} requests" )
+
+        # RETURNING doesn't preserve the subquery's ordering
+        returned_rows.sort( key=lambda curr_row: curr_row[4] )
+        user_submitted_requests = [ _user_request_details_from_row(curr_row) for curr_row in returned_rows ]
+
+        if args.request_order == "fair_share":
+            user_submitted_requests = _interleave_requests_by_user( user_submitted_requests )
+
+        yield user_submitted_requests
+
+
+def _select_fair_share_candidates( args, db_cursor ):
+    # Explaination of query
+    #
+    #   actionable_users walks submitted_requests_user_actionable_idx one user at a time (a loose index
+    #   scan), so listing the users with outstanding requests costs one index probe per user, not a pass
+    #   over their backlogs. For each of them the LATERAL subquery takes their oldest claimable requests,
+    #   at most lease_requests_per_user, and the oldest batch_size of all those are the candidates.
+    #
+    #   Users whose oldest request is oldest come first, and anyone served in the previous batch has had
+    #   those requests leased or attempted since, so users take turns instead of the head of the queue
+    #   getting every batch. Nothing is locked here; the claim re-checks each candidate as it locks it
+    sql_command = """
+        WITH RECURSIVE actionable_users( flickr_user_cognito_id ) AS (
+            (
+                SELECT  flickr_user_cognito_id
+                FROM submitted_requests
+                WHERE has_permanent_status = FALSE
+                ORDER BY flickr_user_cognito_id
+                LIMIT 1
+            )
+            UNION ALL
+            SELECT (
+                SELECT  next_user_request.flickr_user_cognito_id
+                FROM submitted_requests AS next_user_request
+                WHERE next_user_request.has_permanent_status = FALSE
+                    AND next_user_request.flickr_user_cognito_id > actionable_users.flickr_user_cognito_id
+                ORDER BY next_user_request.flickr_user_cognito_id
+                LIMIT 1 )
+            FROM actionable_users
+            WHERE actionable_users.flickr_user_cognito_id IS NOT NULL
+        )
+        SELECT      oldest_user_requests.uuid_pk
+        FROM actionable_users
+        CROSS JOIN LATERAL (
+            SELECT  uuid_pk,
+                    request_datetime
+            FROM submitted_requests
+            WHERE submitted_requests.flickr_user_cognito_id = actionable_users.flickr_user_cognito_id
+                AND has_permanent_status = FALSE
+                AND ( last_attempt_started IS NULL OR DATE(last_attempt_started) <> DATE(NOW()) )
+                AND ( lease_expires IS NULL OR lease_expires < NOW() )
+            ORDER BY request_datetime
+            LIMIT %s
+        ) AS oldest_user_requests
+        ORDER BY oldest_user_requests.request_datetime
+        LIMIT %s;
+    """
+
+    db_cursor.execute( sql_command, (args.lease_requests_per_user, args.batch_size),
+        statement_label="lease_candidates_fair_share" )
+
+    return [ str(returned_row[0]) for returned_row in db_cursor.fetchall() ]
+
+
+def _release_request_leases( args, db_conn, hold_unattempted ):
+    # Requests we attempted are already excluded for the rest of the day by their attempt, so their leases
+    # can simply go.
+    #
+    # Anything we leased but didn't attempt while there was still budget was skipped on purpose (no auth file
+    # for the user, or the user's requests failed). Handing those back would have the next claim, ours or
+    # another worker's, take them straight back, over and over, so instead they stay unclaimable until the
+    # end of the day. Only when the budget ran out (hold_unattempted False) is the rest handed back for
+    # workers that still have some
+    sql_command = """
+        UPDATE submitted_requests
+        SET lease_owner = NULL,
+            lease_expires = CASE
+                WHEN %s AND ( last_attempt_started IS NULL OR DATE(last_attempt_started) <> DATE(NOW()) )
+                    THEN DATE_TRUNC( 'day', NOW() ) + INTERVAL '1 day'
+                ELSE NULL
+            END
+        WHERE lease_owner = %s;
+    """
+
+    with fga_metrics.labelled_cursor( db_conn, "lease_release" ) as db_cursor:
+        db_cursor.execute( sql_command, (hold_unattempted, args.lease_owner) )
+    db_conn.commit()
+
+
+def _user_request_details_from_row( curr_user_request ):
+    #print( "Got user request: " + json.dumps(curr_user_request, default=str) )
+
+    return {
+        "request_id"                    : curr_user_request[0],
+        "request_user_cognito_id"       : curr_user_request[1],
+        "request_flickr_picture_id"     : curr_user_request[2],
+        "request_flickr_group_id"       : curr_user_request[3],
+    }
+
+
+def _add_pics_to_groups( args,  app_flickr_api_key_info, user_flickr_auth_info ):
+    stats = _new_stats()
+
+    with open( args.postgres_creds_json, "r" ) as pgsql_creds_handle:
+        pgsql_creds = json.load( pgsql_creds_handle )
+
+    # Re-read from worker threads, so it gets its own connection
+    throttle_db_conn = _connect_to_db( pgsql_creds )
+    throttle_registry = _GroupThrottleRegistry( args.group_throttle_refresh_seconds )
+    lookup_cache = fga_lookup_cache.open_lookup_cache( args )
+
+    # Leasing workers share the API key, so they share its budget too. Reservations get their own connection
+    # since they're made from whichever thread's call needs one
+    if args.lease_requests and args.api_calls_per_hour is not None:
+        budget_db_conn = _connect_to_db( pgsql_creds )
+        shared_api_budget = _SharedApiCallBudget( budget_db_conn, app_flickr_api_key_info['api_key'],
+            args.api_calls_per_hour, args.api_write_reserve_fraction, args.api_budget_reservation_size )
+    else:
+        budget_db_conn = None
+        shared_api_budget = None
+
+    api_scheduler = _ApiCallScheduler( args.api_calls_per_hour, args.api_write_reserve_fraction, shared_api_budget )
+
+    # Pull all DB requests, ordered chronologically
+    db_conn = _connect_to_db( pgsql_creds )
+    try:
+        throttle_registry.load( throttle_db_conn )
+
+        if args.lease_requests:
+            request_batches = _claim_request_batches( args, db_conn )
+        else:
+            request_batches = _stream_request_batches( args, db_conn )
+
+        if args.dispatch_mode == "serial":
+            flickrapi_handle = _create_flickr_api_handle(args, app_flickr_api_key_info, user_flickr_auth_info,
+                api_scheduler)
+            user_groups = {}
+            attempt_journal = _create_attempt_journal( args, db_conn )
+
+        elif args.dispatch_mode == "per_user":
+            # The journal gets its own connection: worker threads flush through it while this thread reads
+            # the next batch
+            print( f"Dispatching requests per user ({args.max_concurrent_requests} requests at a time, " +
+                f"{args.max_concurrent_requests_per_user} at a time per user)" )
+            journal_db_conn = _connect_to_db( pgsql_creds )
+            attempt_journal = _create_attempt_journal( args, journal_db_conn )
+            per_user_dispatcher = _PerUserDispatcher( args, app_flickr_api_key_info, lookup_cache, throttle_registry,
+                api_scheduler, attempt_journal )
+
+        try:
+            for user_submitted_requests in request_batches:
+                if args.dispatch_mode == "serial":
+                    # Pictures from earlier batches are still in the persistent lookup cache if we see them again
+                    groups_per_pic = {}
+
+                    try:
+                        _process_user_requests( flickrapi_handle, user_flickr_auth_info['user_nsid'], lookup_cache,
+                            attempt_journal, throttle_registry, api_scheduler, user_submitted_requests, user_groups,
+                            groups_per_pic, stats )
+                    finally:
+                        attempt_journal.flush()
+
+                elif args.dispatch_mode == "per_user":
+                    per_user_dispatcher.dispatch( user_submitted_requests )
+
+                if args.lease_requests:
+                    _release_request_leases( args, db_conn, hold_unattempted=not api_scheduler.is_exhausted() )
+
+                # Anything not yet pulled from the DB (or leased) is simply still pending for the next run
+                if api_scheduler.is_exhausted():
+                    print( "API call budget used up, stopping" )
+                    break
+
+                #print( "Done printing requests" )
+
+        finally:
+            if args.dispatch_mode == "per_user":
+                try:
+                    _merge_stats( stats, per_user_dispatcher.finish() )
+                    attempt_journal.flush()
+                finally:
+                    journal_db_conn.close()
+
+    finally:
+        db_conn.close()
+        throttle_db_conn.close()
+
+        if budget_db_conn is not None:
+            try:
+                shared_api_budget.release_unused()
+            finally:
+                budget_db_conn.close()
+
+    for ( call_type, call_count ) in api_scheduler.get_calls_made().items():
+        stats[ f"api_calls_{call_type}" ] = call_count
+
+    for ( cache_stat_name, cache_stat_value ) in lookup_cache.get_stats().items():
+        stats[ f"lookup_cache_{cache_stat_name}" ] = cache_stat_value
+    lookup_cache.close()
+  
+    return stats
+
+
+
+    # Iterate over all JSON files in the specified directory
+    for curr_json_file in glob.glob( os.path.join( args.request_set_json_dir, "*.json") ):
+        if _is_request_set_json(curr_json_file):
+            print(f"\nReading {curr_json_file}")
+            request_set_state_json_filename = curr_json_file.replace(".json", ".state.json")
+            #print( f"{curr_json_file} is a request set JSON")
+            request_set_info = _read_request_set_with_state( curr_json_file, request_set_state_json_filename )
+            #print( f"Got request set:\n{json.dumps(request_set_info, indent=4, sort_keys=True)}")
+
+            request_state_info = request_set_info['request_set_state']
+
+            for current_pic_id in request_set_info['request_set']:
+                current_pic_info = request_set_info['request_set'][current_pic_id]
+                #print( f"Current entry:\n{json.dumps(request_set_info['request_set'][current_pic_id], indent=4, sort_keys=True)}")
+
+                # Iterate over all the groups we're thinking to add this pic to
+                for current_group_entry in current_pic_info:
+                    # Take first token (separated by whitespace) as the group NSID. The rest is human readability fluff
+                    current_group_id = current_group_entry.split()[0]
+                    # Check state on this entry to make sure it wasn't already added
+                    state_key = _generate_state_key( current_pic_id, current_group_id )
+                    #print( f"State key: {state_key}")
+                    if state_key in request_state_info:
+                        state_entry = request_state_info[state_key]
+                        if state_entry['photo_added']:
+                            print( f"\tSkipping photo {current_pic_id} to group {current_group_id}, already added")
+                            stats['skipped_already_added'] += 1
+                            continue
+                        elif _has_add_attempt_within_same_utc_day(state_entry):
+                            print( f"\tSkipping photo {current_pic_id} to group {current_group_id}, already had a failure today (same UTC date)" )
+                            stats['skipped_too_soon'] += 1
+                            continue
+                    else:
+                        #print( f"INFO: Creating state entry for pic {current_pic_id} into group {current_group_id} as it wasn't in state info")
+                        _create_state_entry(request_state_info, current_pic_id, current_group_id )
+                        state_entry = request_state_info[state_key]
+
+                    # Attempt add, because either state says we haven't succeeded yet or there *was* no state yet
+                    #print( "attempting add")
+                    _add_pic_to_group( flickrapi_handle, current_pic_id, current_group_id, state_entry )
+                    if state_entry['fga_add_attempts'][-1]['status'] == 'success':
+                        stats['attempted_success'] += 1
+                    else:
+                        stats['attempted_fail'] += 1
+
+            _persist_request_set_state( request_set_info['request_set_state'], request_set_state_json_filename )
+        else:
+            #print( f"\tSkipping {curr_json_file}, not a request set file")
+            pass
+
+    return stats
+
+def _main():
+    global _row_logging_enabled
+
+    args = _parse_args()
+    _row_logging_enabled = not args.quiet
+
+    # Get auth info
+    app_flickr_api_key_info = _read_app_flickr_api_key_info( args )
+    user_flickr_auth_info = _read_user_flickr_auth_info( args )
+
+    # Ready to kick off the operations
+    stats = _add_pics_to_groups( args, app_flickr_api_key_info, user_flickr_auth_info )
+    print( "\nOperation stats:\n" + json.dumps(stats, indent=4, sort_keys=True))
+
+    if args.metrics_prom_textfile is not None:
+        fga_metrics.run_metrics.write_prometheus_textfile( args.metrics_prom_textfile, stats )
+
+    if args.metrics_jsonl is not None:
+        fga_metrics.run_metrics.write_jsonl( args.metrics_jsonl, stats )
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,355 @@
+import argparse
+import json
+import flickrapi
+import re
+import html
+import copy
+import os.path
+import psycopg2
+import psycopg2.extras
+import uuid
+import datetime
+import fga_lookup_cache
+import csv
+import concurrent.futures
+
+
+def _remove_groups_pic_already_in( flickrapi_handle, lookup_cache, request_set, max_concurrent_lookups=1 ):
+    # Prefetch every picture's groups at once; with hundreds of pictures the serial getAllContexts
+    # round trips were most of the time spent here
+    with concurrent.futures.ThreadPoolExecutor( max_workers=max_concurrent_lookups ) as lookup_executor:
+        groups_per_pic = dict( zip( request_set['fga_request_set'], lookup_executor.map(
+            lambda pic_id: _try_get_group_memberships_for_pic( flickrapi_handle, lookup_cache, pic_id ),
+            request_set['fga_request_set'] ) ) )
+
+    # Pictures we couldn't look up are dropped, everything else still gets submitted
+    skipped_pic_ids = [ pic_id for pic_id in groups_per_pic if groups_per_pic[pic_id] is None ]
+    for pic_id in skipped_pic_ids:
+        del request_set['fga_request_set'][pic_id]
+
+    for pic_id in request_set['fga_request_set']:
+        groups_pic_in = groups_per_pic[ pic_id ]
+        request_set_pruned_group_strings = []
+        for curr_group_string in request_set['fga_request_set'][pic_id]:
+            group_id = curr_group_string.split(" - ")[0]
+            if group_id not in groups_pic_in:
+                request_set_pruned_group_strings.append( curr_group_string )
+            else:
+                print( f"\tDropping out group {curr_group_string} due to pic already in that group" )
+
+        # Drop the pruned set back in
+        request_set['fga_request_set'][pic_id] = request_set_pruned_group_strings
+
+    return skipped_pic_ids
+
+
+def _try_get_group_memberships_for_pic( flickrapi_handle, lookup_cache, pic_id ):
+    # e.g. a deleted or private picture in a bulk import file; returns None so the rest can carry on
+    try:
+        return fga_lookup_cache.get_group_memberships_for_pic( flickrapi_handle, lookup_cache, pic_id )
+    except flickrapi.exceptions.FlickrError as e:
+        print( f"\tCould not look up groups for picture {pic_id}, skipping it: {e}" )
+        return None
+
+
+def _write_requests_to_sql_db( args, request_set ):
+    with open( args.postgres_creds_json, "r" ) as pgsql_creds_handle:
+        pgsql_creds = json.load( pgsql_creds_handle )
+
+    current_timestamp = datetime.datetime.now(datetime.timezone.utc)
+    request_rows = []
+    for curr_photo_id in request_set['fga_request_set']:
+        for group_descriptor in request_set['fga_request_set'][curr_photo_id]:
+            request_rows.append( (
+                str( uuid.uuid4() ),
+                args.user_cognito_id,
+                curr_photo_id,
+                group_descriptor.split(" - ")[0],
+                current_timestamp
+            ) )
+
+    insert_counts = {
+        'inserted'      : 0,
+        'duplicates'    : 0,
+    }
+
+    if not request_rows:
+        return insert_counts
+
+    #print( "DB creds:\n" + json.dumps(pgsql_creds, indent=4, sort_keys=True) )
+    with psycopg2.connect(
+        host        = pgsql_creds['db_host'],
+        user        = pgsql_creds['db_user'],
+        password    = pgsql_creds['db_passwd'],
+        database    = pgsql_creds['db_dbname'] ) as db_conn:
+
+
+        with db_conn.cursor() as db_cursor:
+            sql_command = \
+"""INSERT INTO submitted_requests (
+    uuid_pk,
+    flickr_user_cognito_id,
+    picture_flickr_id,
+    flickr_group_id,
+    request_datetime ) 
+VALUES %s
+ON CONFLICT (flickr_user_cognito_id, picture_flickr_id, flickr_group_id) DO NOTHING
+RETURNING uuid_pk;"""
+
+            # All rows in one statement; rows that hit the unique constraint don't come back from RETURNING
+            inserted_rows = psycopg2.extras.execute_values( db_cursor, sql_command, request_rows,
+                page_size=len(request_rows), fetch=True )
+
+    db_conn.close()
+
+    insert_counts['inserted'] = len( inserted_rows )
+    insert_counts['duplicates'] = len( request_rows ) - len( inserted_rows )
+
+    return insert_counts
+
+
+def _read_batch_import_file( batch_import_filename ):
+    # JSON files use the same request set layout the interactive mode builds:
+    #
+    #   { "fga_request_set": { "<picture id>": [ "<group id> - <group name>", ... ] } }
+    #
+    # CSV files have a header row and picture_flickr_id, flickr_group_id columns
+    if batch_import_filename.lower().endswith( ".csv" ):
+        request_set = { 'fga_request_set': {} }
+        with open( batch_import_filename, "r", newline="" ) as batch_import_handle:
+            for csv_row in csv.DictReader( batch_import_handle ):
+                request_set['fga_request_set'].setdefault( csv_row['picture_flickr_id'].strip(), [] ).append(
+                    csv_row['flickr_group_id'].strip() )
+
+        return request_set
+
+    with open( batch_import_filename, "r" ) as batch_import_handle:
+        request_set = json.load( batch_import_handle )
+
+    if 'fga_request_set' not in request_set:
+        raise ValueError( f"{batch_import_filename} has no fga_request_set" )
+
+    return request_set
+
+
+def _persist_request_set_to_disk( args, request_set ):
+    for photo_id in request_set['fga_request_set']:
+        with open( os.path.join(args.request_set_json_dir, f"fga_request_set_photo_{photo_id}.json"), "w") as request_set_handle:
+            json.dump( request_set, request_set_handle, indent=4, sort_keys=True )
+
+
+def _determine_subsets( group_memberships, currently_selected_groups ):
+    subsets = {
+        'selected'      : [],
+        'unselected'    : [],
+    }
+
+    for curr_name_index in sorted(group_memberships):
+        #print( f"Found group {human_readable_version}")
+
+        if curr_name_index in currently_selected_groups:
+            proper_subset = subsets['selected']
+            #print( "\tGroup is selected")
+        else:
+            proper_subset = subsets['unselected']
+            #print( "\tGroup is not selected")
+
+        proper_subset.append( curr_name_index )
+
+    return subsets
+
+
+def _create_fga_request_set( flickapi_handle, group_memberships, picture_id ):
+    currently_selected_groups = {}
+
+    while True:
+        print( f"\n\nPicture ID: {picture_id}")
+        group_subsets = _determine_subsets( group_memberships, currently_selected_groups )
+
+        print( "\nSelected Groups:\n" )
+
+        for curr_group_index in group_subsets['selected']:
+            print(f"\t{group_memberships[curr_group_index]['display']}" )
+
+        print( "\n\nUnselected Groups:\n" )
+
+        for curr_group_index in group_subsets['unselected']:
+            print(f"\t{group_memberships[curr_group_index]['display']}" )
+
+        selected_group_key_str = str( input("\n\nGroup ID (Enter to exit): ") )
+
+        #print( f"Got input: \"{selected_group_key}\"")
+
+        if not selected_group_key_str:
+            break
+
+        selected_group_key = int( selected_group_key_str )
+
+        if selected_group_key < 1 or selected_group_key > len(group_memberships):
+            print( f"WARNING: {selected_group_key} is an invalid entry, ignoring and trying again" )
+            continue
+
+        # If that group index is found in selected groups, delete it
+        if selected_group_key in currently_selected_groups:
+            del currently_selected_groups[selected_group_key]
+        else:
+            currently_selected_groups[selected_group_key] = None
+
+    print( "Broke out of loop")
+
+    # Build the request set
+    request_set_entries = []
+    for name_index in sorted(currently_selected_groups):
+        request_set_entries.append( f"{group_memberships[name_index]['nsid']} - {group_memberships[name_index]['name']}")
+
+    fga_request_set = {
+        "fga_request_set": {
+            picture_id: request_set_entries
+        }
+    }
+
+    print( json.dumps( fga_request_set, indent=4, sort_keys=True ) )
+
+    return fga_request_set
+
+
+def _get_picture_id():
+    # Get pic ID from URL
+    picture_url = str( input( "\nEnter picture's URL on Flickr: "))
+
+    # Find the picture ID which should be the only token with 8+ numeric digits
+    search_results = re.findall( r'\/(\d{8,})\/', picture_url )
+    if len( search_results) != 1:
+        raise ValueError("Could not find picture ID in URL")
+
+    #print(f"Search results: {search_results}")
+    extracted_pic_id = search_results[0]
+    print( f"Parsed picture ID {extracted_pic_id}")
+    return extracted_pic_id
+
+
+def _get_user_groups(flickrapi_handle, lookup_cache, user_nsid, refresh_groups=False):
+    # Test our handle, print out our authenticated NSID or something
+    # A cached list can predate groups the user joined since; --refresh-groups fetches it again
+    user_groups = fga_lookup_cache.get_user_groups( flickrapi_handle, lookup_cache, user_nsid,
+        require_fresh=refresh_groups )
+
+    #pprint.pprint( user_groups )
+    group_membership_info = {}
+    # Sort the user's groups by name and assign them a display key now
+    for curr_user_group in user_groups:
+        curr_user_group['name'] = html.unescape(curr_user_group['name'])
+
+    sorted_user_groups = sorted( user_groups, key=lambda curr_user_group: curr_user_group['name'].casefold() )
+
+    # Key the dictionary of group info by name index
+    for (name_index, curr_user_group) in enumerate(sorted_user_groups):
+        group_membership_info[ name_index + 1 ] = {
+            'name': curr_user_group['name'],
+            'display': f"{name_index + 1:3d}: {curr_user_group['name']} ({curr_user_group['nsid']})",
+            'nsid': curr_user_group['nsid'],
+        }
+
+    return group_membership_info
+
+
+def _create_flickr_api_handle( app_flickr_api_key_info, user_flickr_auth_info ):
+    # Create an OAuth User Token that flickr API library understands
+    api_access_level = "write"
+    flickrapi_user_token = flickrapi.auth.FlickrAccessToken(
+        user_flickr_auth_info['user_oauth_token'],
+        user_flickr_auth_info['user_oauth_token_secret'],
+        api_access_level,
+        user_flickr_auth_info['user_fullname'],
+        user_flickr_auth_info['username'],
+        user_flickr_auth_info['user_nsid'])
+
+    flickrapi_handle = flickrapi.FlickrAPI(app_flickr_api_key_info['api_key'],
+                                           app_flickr_api_key_info['api_key_secret'],
+                                           token=flickrapi_user_token,
+                                           store_token=False,
+                                           format='parsed-json')
+
+    return flickrapi_handle
+
+
+def _read_user_flickr_auth_info(args):
+    with open( args.user_auth_info_json, "r") as user_auth_info_handle:
+        user_auth_info = json.load( user_auth_info_handle )
+
+    return user_auth_info
+
+
+def _read_app_flickr_api_key_info(args):
+    with open(args.app_api_key_info_json, "r") as app_api_key_info_handle:
+        app_api_key_info = json.load(app_api_key_info_handle)
+
+    return app_api_key_info
+
+
+def _parse_args():
+    arg_parser = argparse.ArgumentParser(description="Get list of groups for this user")
+    arg_parser.add_argument( "app_api_key_info_json", help="JSON file with app API auth info")
+    arg_parser.add_argument( "user_auth_info_json", help="JSON file with user auth info")
+    #arg_parser.add_argument( "request_set_json_dir", help="Directory where FGA request set JSON files should be stored" )
+    arg_parser.add_argument( "postgres_creds_json", help="JSON file with all info for writing to Postgres" )
+    arg_parser.add_argument( "--user-cognito-id", default=None,
+        help="Cognito ID of the user the requests are submitted for (required with --batch-import-file)" )
+    arg_parser.add_argument( "--batch-import-file", default=None,
+        help="Submit every request in this JSON request set or CSV (picture_flickr_id,flickr_group_id) " +
+            "file instead of prompting for one picture" )
+    arg_parser.add_argument( "--max-concurrent-lookups", type=int, default=8,
+        help="Pictures whose current groups are looked up on Flickr at the same time" )
+    arg_parser.add_argument( "--refresh-groups", action="store_true",
+        help="Fetch your group list from Flickr instead of the lookup cache (e.g. after joining a group)" )
+    fga_lookup_cache.add_lookup_cache_args( arg_parser )
+    args = arg_parser.parse_args()
+
+    # A whole import file silently landing on the default account is much worse than one interactive request
+    if args.user_cognito_id is None:
+        if args.batch_import_file is not None:
+            arg_parser.error( "--batch-import-file needs --user-cognito-id" )
+
+        args.user_cognito_id = "f803355d-4396-4b79-b7b8-d887402b25cd"
+
+    return args
+
+
+def _main():
+    args = _parse_args()
+
+    app_flickr_api_key_info = _read_app_flickr_api_key_info( args )
+    user_flickr_auth_info = _read_user_flickr_auth_info( args )
+    flickrapi_handle = _create_flickr_api_handle(app_flickr_api_key_info, user_flickr_auth_info)
+    lookup_cache = fga_lookup_cache.open_lookup_cache( args )
+
+    if args.batch_import_file is not None:
+        request_set = _read_batch_import_file( args.batch_import_file )
+        request_count = sum( [ len(group_strings) for group_strings in request_set['fga_request_set'].values() ] )
+        print( f"Read {request_count} requests for {len(request_set['fga_request_set'])} pictures from " +
+            args.batch_import_file )
+    else:
+        group_memberships = _get_user_groups(flickrapi_handle, lookup_cache, user_flickr_auth_info['user_nsid'],
+            args.refresh_groups)
+        #print( "Memberships:\n" + json.dumps(group_memberships, indent=4, sort_keys=True))
+
+        picture_id = _get_picture_id()
+        request_set = _create_fga_request_set( flickrapi_handle, group_memberships, picture_id )
+        #_persist_request_set_to_disk( args, request_set )
+
+    skipped_pic_ids = _remove_groups_pic_already_in( flickrapi_handle, lookup_cache, request_set,
+        args.max_concurrent_lookups )
+    if skipped_pic_ids:
+        print( f"\nSkipped {len(skipped_pic_ids)} pictures whose groups couldn't be looked up: " +
+            ", ".join(skipped_pic_ids) )
+
+    insert_counts = _write_requests_to_sql_db( args, request_set )
+
+    print( f"\nInserted {insert_counts['inserted']} requests, skipped {insert_counts['duplicates']} already submitted" )
+
+    print( "\nLookup cache stats:\n" + json.dumps(lookup_cache.get_stats(), indent=4, sort_keys=True) )
+    lookup_cache.close()
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,203 @@
+import json
+import os.path
+import sqlite3
+import threading
+import time
+
+
+default_cache_db_filename   = os.path.join( os.path.expanduser("~"), ".fga_lookup_cache.sqlite3" )
+default_ttl_hours           = 12
+default_max_entries         = 100000
+
+
+def add_lookup_cache_args( arg_parser ):
+    arg_parser.add_argument( "--lookup-cache-db", default=default_cache_db_filename,
+        help="SQLite file caching Flickr group/photo lookups between runs" )
+    arg_parser.add_argument( "--lookup-cache-ttl-hours", type=float, default=default_ttl_hours,
+        help="How long a cached Flickr lookup is trusted" )
+    arg_parser.add_argument( "--lookup-cache-max-entries", type=int, default=default_max_entries,
+        help="Least recently used lookups are evicted past this many entries" )
+
+
+def open_lookup_cache( args ):
+    return LookupCache( args.lookup_cache_db, args.lookup_cache_ttl_hours * 3600, args.lookup_cache_max_entries )
+
+
+def get_group_memberships_for_pic( flickrapi_handle, lookup_cache, pic_id, require_fresh=False ):
+    # The groups a picture is already in, keyed by group ID
+    get_function = lookup_cache.get_or_fetch_fresh if require_fresh else lookup_cache.get_or_fetch
+    return get_function( "pic_groups", pic_id, lambda: fetch_group_memberships_for_pic( flickrapi_handle, pic_id ) )
+
+
+def get_user_groups( flickrapi_handle, lookup_cache, user_nsid, require_fresh=False ):
+    # The groups the handle's user belongs to, as the list groups.pools.getGroups returns
+    get_function = lookup_cache.get_or_fetch_fresh if require_fresh else lookup_cache.get_or_fetch
+    return get_function( "user_groups", user_nsid, lambda: fetch_user_groups( flickrapi_handle ) )
+
+
+def fetch_group_memberships_for_pic( flickrapi_handle, pic_id ):
+    pic_contexts = flickrapi_handle.photos.getAllContexts( photo_id=pic_id )
+
+    group_memberships = {}
+    if 'pool' in pic_contexts:
+        for curr_group in pic_contexts['pool']:
+            group_memberships[ curr_group['id']] = curr_group
+
+    return group_memberships
+
+
+def fetch_user_groups( flickrapi_handle ):
+    user_groups = flickrapi_handle.groups.pools.getGroups()
+
+    if 'groups' in user_groups and 'group' in user_groups['groups']:
+        return user_groups['groups']['group']
+
+    return []
+
+
+class LookupCache:
+    """
+    Persistent cache of Flickr lookups (photos.getAllContexts, groups.pools.getGroups) shared by
+    add_images_to_groups.py and fga_cli_ui.py.
+
+    Entries expire after ttl_seconds, and once there are more than max_entries the least recently used
+    ones are evicted. Counting the entries means a full scan, so that's only checked every
+    max_entries / 100 new entries, and the cache can run up to that many over in between. Values are
+    stored as JSON. Safe to share between threads; several processes can
+    point at the same file.
+
+    Values cached by an earlier run can be up to ttl_seconds old. get_or_fetch_fresh is for lookups that
+    decide something permanent; it only trusts values this process fetched itself.
+    """
+
+    def __init__( self, cache_db_filename, ttl_seconds, max_entries ):
+        self._ttl_seconds   = ttl_seconds
+        self._max_entries   = max_entries
+        self._stores_between_eviction_checks    = max( 1, max_entries // 100 )
+        self._stores_since_eviction_check       = 0
+        self._lock          = threading.Lock()
+        self._fetched_keys  = set()
+        self._stats         = {
+            'hits'          : 0,
+            'misses'        : 0,
+            'refetches'     : 0,
+            'evictions'     : 0,
+            'write_throughs': 0,
+        }
+
+        self._db_conn = sqlite3.connect( cache_db_filename, timeout=30, isolation_level=None,
+            check_same_thread=False )
+        self._db_conn.execute( "PRAGMA journal_mode=WAL;" )
+        self._db_conn.execute( "PRAGMA synchronous=NORMAL;" )
+        self._db_conn.execute( """
+            CREATE TABLE IF NOT EXISTS lookup_cache (
+                cache_key       TEXT PRIMARY KEY,
+                cached_value    TEXT NOT NULL,
+                expires_at      REAL NOT NULL,
+                last_accessed   REAL NOT NULL
+            );
+        """ )
+        self._db_conn.execute(
+            "CREATE INDEX IF NOT EXISTS lookup_cache_last_accessed_idx ON lookup_cache( last_accessed );" )
+        self._db_conn.execute( "DELETE FROM lookup_cache WHERE expires_at <= ?;", (time.time(),) )
+
+    def get_or_fetch( self, lookup_type, lookup_key, fetch_function ):
+        cache_key = _make_cache_key( lookup_type, lookup_key )
+        current_time = time.time()
+
+        with self._lock:
+            cached_row = self._db_conn.execute(
+                "SELECT cached_value FROM lookup_cache WHERE cache_key = ? AND expires_at > ?;",
+                (cache_key, current_time) ).fetchone()
+
+            if cached_row is not None:
+                self._db_conn.execute( "UPDATE lookup_cache SET last_accessed = ? WHERE cache_key = ?;",
+                    (current_time, cache_key) )
+                self._stats['hits'] += 1
+                return json.loads( cached_row[0] )
+
+            self._stats['misses'] += 1
+
+        # Don't hold the lock across the network call
+        fetched_value = fetch_function()
+
+        with self._lock:
+            self._store_locked( cache_key, fetched_value, current_time + self._ttl_seconds )
+            self._fetched_keys.add( cache_key )
+
+        return fetched_value
+
+    def get_or_fetch_fresh( self, lookup_type, lookup_key, fetch_function ):
+        # Same as get_or_fetch once this process has fetched the key itself; a value left by an earlier
+        # run is fetched again first (and the cache refreshed with it)
+        cache_key = _make_cache_key( lookup_type, lookup_key )
+
+        with self._lock:
+            fetched_by_this_process = cache_key in self._fetched_keys
+
+        if fetched_by_this_process:
+            return self.get_or_fetch( lookup_type, lookup_key, fetch_function )
+
+        fetched_value = fetch_function()
+
+        with self._lock:
+            self._store_locked( cache_key, fetched_value, time.time() + self._ttl_seconds )
+            self._fetched_keys.add( cache_key )
+            self._stats['refetches'] += 1
+
+        return fetched_value
+
+    def update_if_cached( self, lookup_type, lookup_key, update_function ):
+        # Write-through for things we changed ourselves (e.g. a successful group add), keeping the
+        # entry's original expiry so it still gets refreshed from Flickr on schedule
+        cache_key = _make_cache_key( lookup_type, lookup_key )
+
+        with self._lock:
+            cached_row = self._db_conn.execute(
+                "SELECT cached_value FROM lookup_cache WHERE cache_key = ? AND expires_at > ?;",
+                (cache_key, time.time()) ).fetchone()
+
+            if cached_row is None:
+                return
+
+            updated_value = update_function( json.loads(cached_row[0]) )
+            self._db_conn.execute(
+                "UPDATE lookup_cache SET cached_value = ?, last_accessed = ? WHERE cache_key = ?;",
+                (json.dumps(updated_value), time.time(), cache_key) )
+            self._stats['write_throughs'] += 1
+
+    def get_stats( self ):
+        with self._lock:
+            return dict( self._stats )
+
+    def close( self ):
+        with self._lock:
+            self._db_conn.close()
+
+    def _store_locked( self, cache_key, cached_value, expires_at ):
+        self._db_conn.execute( """
+            INSERT INTO lookup_cache( cache_key, cached_value, expires_at, last_accessed )
+            VALUES ( ?, ?, ?, ? )
+            ON CONFLICT( cache_key ) DO UPDATE SET
+                cached_value = excluded.cached_value,
+                expires_at = excluded.expires_at,
+                last_accessed = excluded.last_accessed;
+        """, (cache_key, json.dumps(cached_value), expires_at, time.time()) )
+
+        self._stores_since_eviction_check += 1
+        if self._stores_since_eviction_check < self._stores_between_eviction_checks:
+            return
+
+        self._stores_since_eviction_check = 0
+        entry_count = self._db_conn.execute( "SELECT COUNT(*) FROM lookup_cache;" ).fetchone()[0]
+        if entry_count > self._max_entries:
+            evicted_rows = self._db_conn.execute( """
+                DELETE FROM lookup_cache
+                WHERE cache_key IN (
+                    SELECT cache_key FROM lookup_cache ORDER BY last_accessed LIMIT ? );
+            """, (entry_count - self._max_entries,) ).rowcount
+            self._stats['evictions'] += evicted_rows
+
+
+def _make_cache_key( lookup_type, lookup_key ):
+    return f"{lookup_type}:{lookup_key}"
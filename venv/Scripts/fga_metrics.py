@@ -0,0 +1,252 @@
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+import psycopg2.extensions
+
+
+latency_buckets_seconds     = ( 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0 )
+calls_per_request_buckets   = ( 0, 1, 2, 3, 4, 5, 10 )
+
+
+def add_metrics_args( arg_parser ):
+    arg_parser.add_argument( "--metrics-prom-textfile", default=None,
+        help="Write run metrics here in Prometheus text format (e.g. for the node_exporter textfile collector)" )
+    arg_parser.add_argument( "--metrics-jsonl", default=None,
+        help="Append run metrics to this file, one JSON object per metric series" )
+
+
+class _Histogram:
+    def __init__( self, bucket_bounds ):
+        self.bucket_bounds  = bucket_bounds
+        self.bucket_counts  = [ 0 ] * len( bucket_bounds )
+        self.count          = 0
+        self.sum            = 0.0
+
+    def observe( self, value ):
+        self.count += 1
+        self.sum += value
+        for ( bucket_index, bucket_bound ) in enumerate( self.bucket_bounds ):
+            if value <= bucket_bound:
+                self.bucket_counts[ bucket_index ] += 1
+                break
+
+
+class RunMetrics:
+    """
+    Latency histograms and counters for one run, cheap enough to update on every request and every
+    SQL statement; nothing is written out until export at the end of the run. Safe to share between
+    threads.
+
+    Series are identified by (metric name, label name, label value), e.g.
+    ("fga_flickr_call_seconds", "method", "groups.pools.add").
+    """
+
+    def __init__( self ):
+        self._lock          = threading.Lock()
+        self._histograms    = {}
+        self._counters      = {}
+        self._request_state = threading.local()
+
+    def observe( self, metric_name, label_name, label_value, value, bucket_bounds=latency_buckets_seconds ):
+        series_key = ( metric_name, label_name, label_value )
+        with self._lock:
+            if series_key not in self._histograms:
+                self._histograms[ series_key ] = _Histogram( bucket_bounds )
+            self._histograms[ series_key ].observe( value )
+
+    @contextlib.contextmanager
+    def time_latency( self, metric_name, label_name, label_value ):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe( metric_name, label_name, label_value, time.perf_counter() - start_time )
+
+    def increment( self, metric_name, label_name, label_value, amount=1 ):
+        series_key = ( metric_name, label_name, label_value )
+        with self._lock:
+            self._counters[ series_key ] = self._counters.get( series_key, 0 ) + amount
+
+    def time_flickr_call( self, method_name ):
+        # Also counted against whichever request this thread is working on
+        self._request_state.flickr_calls = getattr( self._request_state, "flickr_calls", 0 ) + 1
+        return self.time_latency( "fga_flickr_call_seconds", "method", method_name )
+
+    def begin_request( self ):
+        self._request_state.flickr_calls = 0
+
+    def end_request( self, final_status ):
+        self.increment( "fga_requests_total", "final_status", _final_status_label(final_status) )
+        self.observe( "fga_flickr_calls_per_request", "", "", getattr(self._request_state, "flickr_calls", 0),
+            calls_per_request_buckets )
+
+    def write_prometheus_textfile( self, textfile_filename, run_stats ):
+        prometheus_lines = []
+
+        with self._lock:
+            typed_metric_names = set()
+            for series_key in sorted( self._histograms ):
+                ( metric_name, label_name, label_value ) = series_key
+                histogram = self._histograms[ series_key ]
+                series_labels = _prometheus_labels( label_name, label_value )
+
+                # Once per metric, ahead of its first series; series of one metric sort next to each other
+                if metric_name not in typed_metric_names:
+                    prometheus_lines.append( f"# TYPE {metric_name} histogram" )
+                    typed_metric_names.add( metric_name )
+
+                cumulative_count = 0
+                for ( bucket_bound, bucket_count ) in zip( histogram.bucket_bounds, histogram.bucket_counts ):
+                    cumulative_count += bucket_count
+                    bucket_labels = _prometheus_labels( label_name, label_value, le=f"{bucket_bound:g}" )
+                    prometheus_lines.append( f"{metric_name}_bucket{bucket_labels} {cumulative_count}" )
+
+                prometheus_lines.append(
+                    f"{metric_name}_bucket{_prometheus_labels(label_name, label_value, le='+Inf')} {histogram.count}" )
+                prometheus_lines.append( f"{metric_name}_sum{series_labels} {histogram.sum}" )
+                prometheus_lines.append( f"{metric_name}_count{series_labels} {histogram.count}" )
+
+            for series_key in sorted( self._counters ):
+                ( metric_name, label_name, label_value ) = series_key
+                if metric_name not in typed_metric_names:
+                    prometheus_lines.append( f"# TYPE {metric_name} counter" )
+                    typed_metric_names.add( metric_name )
+
+                prometheus_lines.append(
+                    f"{metric_name}{_prometheus_labels(label_name, label_value)} {self._counters[series_key]}" )
+
+        prometheus_lines.append( "# TYPE fga_run_stat gauge" )
+        for stat_name in sorted( run_stats ):
+            prometheus_lines.append( f"fga_run_stat{_prometheus_labels('stat', stat_name)} {run_stats[stat_name]}" )
+
+        prometheus_lines.append( "# TYPE fga_run_completed_timestamp_seconds gauge" )
+        prometheus_lines.append( f"fga_run_completed_timestamp_seconds {time.time()}" )
+
+        # Write and rename so a scraper never sees a half-written file
+        temp_filename = f"{textfile_filename}.{os.getpid()}.tmp"
+        with open( temp_filename, "w" ) as textfile_handle:
+            textfile_handle.write( "\n".join(prometheus_lines) + "\n" )
+        os.replace( temp_filename, textfile_filename )
+
+    def write_jsonl( self, jsonl_filename, run_stats ):
+        run_timestamp = time.time()
+
+        with self._lock:
+            metric_records = []
+            for series_key in sorted( self._histograms ):
+                ( metric_name, label_name, label_value ) = series_key
+                histogram = self._histograms[ series_key ]
+                metric_records.append( {
+                    'metric'        : metric_name,
+                    'labels'        : { label_name: label_value } if label_name else {},
+                    'type'          : "histogram",
+                    'buckets'       : dict( zip( [ f"{bucket_bound:g}" for bucket_bound in histogram.bucket_bounds ],
+                        histogram.bucket_counts ) ),
+                    'count'         : histogram.count,
+                    'sum'           : histogram.sum,
+                } )
+
+            for series_key in sorted( self._counters ):
+                ( metric_name, label_name, label_value ) = series_key
+                metric_records.append( {
+                    'metric'        : metric_name,
+                    'labels'        : { label_name: label_value } if label_name else {},
+                    'type'          : "counter",
+                    'value'         : self._counters[ series_key ],
+                } )
+
+        metric_records.append( {
+            'metric'    : "fga_run_stats",
+            'type'      : "stats",
+            'value'     : run_stats,
+        } )
+
+        with open( jsonl_filename, "a" ) as jsonl_handle:
+            for metric_record in metric_records:
+                metric_record['timestamp'] = run_timestamp
+                jsonl_handle.write( json.dumps(metric_record, sort_keys=True, default=str) + "\n" )
+
+
+# One registry per process, in the same spirit as prometheus_client's default registry, so every
+# layer can record into it without it being passed through every function
+run_metrics = RunMetrics()
+
+
+class InstrumentedCursor( psycopg2.extensions.cursor ):
+    """
+    Cursor that times every statement it runs (including the pages execute_values sends) into
+    fga_sql_statement_seconds. Pass as cursor_factory to psycopg2.connect.
+
+    Each statement is labelled with the statement_label passed to execute(), else the cursor's own
+    statement_label (see labelled_cursor; that's what statements run for us by execute_values get), else
+    a guess from the SQL itself. Give every query the script runs its own name: several different ones
+    look like "UPDATE submitted_requests" to the guess.
+    """
+
+    statement_label = None
+
+    def execute( self, query, vars=None, statement_label=None ):
+        with run_metrics.time_latency( "fga_sql_statement_seconds", "statement",
+                self._statement_label_for(query, statement_label) ):
+            return super().execute( query, vars )
+
+    def executemany( self, query, vars_list, statement_label=None ):
+        with run_metrics.time_latency( "fga_sql_statement_seconds", "statement",
+                self._statement_label_for(query, statement_label) ):
+            return super().executemany( query, vars_list )
+
+    def _statement_label_for( self, query, statement_label ):
+        return statement_label or self.statement_label or _sql_statement_label( query )
+
+
+def labelled_cursor( db_conn, statement_label, **cursor_args ):
+    # A cursor from a connection made with InstrumentedCursor whose statements are all timed as statement_label
+    db_cursor = db_conn.cursor( **cursor_args )
+    db_cursor.statement_label = statement_label
+    return db_cursor
+
+
+def _sql_statement_label( query ):
+    # "INSERT group_add_attempts", "SELECT submitted_requests", ... -- bounded, unlike the raw SQL
+    if isinstance( query, bytes ):
+        query = query.decode( "utf-8", errors="replace" )
+
+    statement_match = re.match( r"\s*(WITH|SELECT|INSERT|UPDATE|DELETE|DECLARE)\b", query, re.IGNORECASE )
+    if statement_match is None:
+        return "other"
+
+    statement_type = statement_match.group( 1 ).upper()
+    table_match = re.search( r"\b(?:FROM|INTO|UPDATE)\s+([A-Za-z_][A-Za-z0-9_]*)", query, re.IGNORECASE )
+    if table_match is None:
+        return statement_type
+
+    return f"{statement_type} {table_match.group(1)}"
+
+
+def _final_status_label( final_status ):
+    # fail_ statuses carry the whole Flickr error message; keep just the error code so the label
+    # doesn't get a new value for every distinct message
+    if final_status.startswith( "fail_" ):
+        error_code_match = re.search( r"Error: (\d+)", final_status )
+        if error_code_match is not None:
+            return f"fail_error_{error_code_match.group(1)}"
+        return "fail_other"
+
+    return final_status
+
+
+def _prometheus_labels( label_name, label_value, le=None ):
+    label_pairs = []
+    if label_name:
+        escaped_value = str( label_value ).replace( "\\", "\\\\" ).replace( "\"", "\\\"" ).replace( "\n", "\\n" )
+        label_pairs.append( f"{label_name}=\"{escaped_value}\"" )
+    if le is not None:
+        label_pairs.append( f"le=\"{le}\"" )
+
+    if not label_pairs:
+        return ""
+
+    return "{" + ",".join( label_pairs ) + "}"